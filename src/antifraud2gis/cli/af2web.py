@@ -25,11 +25,12 @@ from rich import print_json
 
 from ..company import Company, CompanyList
 from ..exceptions import AFReportNotReady, AFNoCompany, AFNoTitle, AFCompanyError
-from ..tasks import submit_fraud_task, get_qsize
+from ..tasks import submit_fraud_task, get_qsize, queue_position
 from ..settings import settings
 from ..const import REDIS_TASK_QUEUE_NAME, REDIS_TRUSTED_LIST, REDIS_UNTRUSTED_LIST, REDIS_WORKER_STATUS
 # from ..search import search
 from ..companydb import dbsearch
+from ..companyinfo import CompanyInfo
 from ..compare import compare
 from ..logger import loginit, testlogger
 
@@ -141,14 +142,11 @@ async def report(request: Request, oid: str):
 
             report_reliable = c.report_reliable(report=report)
 
+            # trusted status of related companies from SQLite, no Company() and no report files
+            companies = CompanyInfo.lookup_many(rel['oid'] for rel in report['relations'])
             for rel in report['relations']:
-                rep_path = settings.company_storage / (rel['oid'] + '-report.json.gz')
-                if rep_path.exists():
-                    with gzip.open(rep_path, "rt") as fh:
-                        rel_report = json.load(fh)
-                        rel['trusted'] = rel_report['score']['trusted']
-                else:
-                    rel['trusted'] = None
+                info = companies.get(rel['oid'])
+                rel['trusted'] = info.trusted if info else None
 
             last_trusted = [json.loads(item) for item in r.lrange(REDIS_TRUSTED_LIST, 0, -1)]
             last_untrusted = [json.loads(item) for item in r.lrange(REDIS_UNTRUSTED_LIST, 0, -1)]
@@ -324,17 +322,8 @@ async def progress(request: Request, oid: str):
     if c.report_path.exists():
         return RedirectResponse(app.url_path_for("report", oid=oid))
 
-    wstatus = r.get(REDIS_WORKER_STATUS)
-    tasks = r.lrange(REDIS_TASK_QUEUE_NAME, 0, -1)  # возвращает list of bytes    
-    queue_size = len(tasks)
-    try:
-        qpos = tasks.index(oid) + 1
-    except ValueError:
-        qpos=None
-    
-
-    # position = next((i for i, task in enumerate(tasks) if task_id in str(task)), None)
-    # print("pos:", position)
+    # constant-size redis calls: task state, ZRANK in queue, durations of last tasks
+    qinfo = queue_position(oid)
 
     last_trusted = [json.loads(item) for item in r.lrange(REDIS_TRUSTED_LIST, 0, -1)]
     last_untrusted = [json.loads(item) for item in r.lrange(REDIS_UNTRUSTED_LIST, 0, -1)]
@@ -344,7 +333,8 @@ async def progress(request: Request, oid: str):
         request,
         "progress.html", {
             "request": request, "title": c.title, "oid": c.object_id,
-            "qsize": queue_size, "wstatus": wstatus, "qpos": qpos,
+            "qsize": qinfo['qsize'] + qinfo['bulk_qsize'], "qpos": qinfo['qpos'], "tstate": qinfo['state'],
+            "eta": int(qinfo['eta'] / 60) + 1 if qinfo['eta'] is not None else None,
             "trusted": last_trusted,
             "untrusted": last_untrusted
         }
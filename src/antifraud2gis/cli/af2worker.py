@@ -1,32 +1,48 @@
+import argparse
 import dramatiq
 import sys
 import redis
 import time
-from ..const import REDIS_WORKER_STARTED
+from ..const import REDIS_WORKER_STARTED, REDIS_WORKER_CONCURRENCY
+from ..settings import settings
 from ..tasks import fraud_task, set_status
 from dramatiq.cli import main as dramatiq_main
 from ..logger import logger, loginit
 
 """
 af2worker antifraud2gis.tasks
+
+    af2worker -p 4 -t 2     4 processes with 2 threads each (8 detections in parallel)
 """
+
+def get_args():
+    parser = argparse.ArgumentParser(description='antifraud2gis worker (dramatiq)')
+    parser.add_argument("-p", "--processes", metavar='N', type=int, default=settings.worker_processes,
+                        help=f"worker processes (default: {settings.worker_processes}, WORKER_PROCESSES)")
+    parser.add_argument("-t", "--threads", metavar='N', type=int, default=settings.worker_threads,
+                        help=f"threads per process (default: {settings.worker_threads}, WORKER_THREADS)")
+    return parser.parse_args()
+
 def main():
 
+    args = get_args()
 
     r = redis.Redis(
         decode_responses=True
     )
 
 
-    sys.argv = ["dramatiq", "-p1", "-t1", "antifraud2gis.tasks"]
+    sys.argv = ["dramatiq", f"-p{args.processes}", f"-t{args.threads}", "antifraud2gis.tasks"]
     loglevel = "DEBUG" # (or "INFO")
     loginit(loglevel)
-    logger.debug(f"Starting dramatiq worker ({loglevel})")
+    logger.debug(f"Starting dramatiq worker ({loglevel}), {args.processes} processes x {args.threads} threads")
 
     set_status("worker started")
     r.set(REDIS_WORKER_STARTED, time.time())
+    # for ETA on /progress
+    r.set(REDIS_WORKER_CONCURRENCY, args.processes * args.threads)
+
 
-    
 
     dramatiq_main()
 
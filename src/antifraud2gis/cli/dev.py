@@ -16,10 +16,9 @@ from collections import defaultdict
 import numpy as np
 import json
 import gzip
-import lmdb
 
-from ..company import CompanyList, Company
-from ..user import User, reset_user_pool
+from ..company import CompanyList, Company, prefetch_companies
+from ..user import User, reset_user_pool, random_user
 from ..settings import settings
 from ..fraud import detect, dump_report
 from ..exceptions import AFNoCompany, AFNoTitle, AFCompanyError
@@ -27,13 +26,19 @@ from ..aliases import aliases
 from .summary import printsummary
 from ..tasks import submit_fraud_task, cooldown_queue
 from ..const import REDIS_TASK_QUEUE_NAME, REDIS_TRUSTED_LIST, REDIS_UNTRUSTED_LIST, REDIS_WORKER_STATUS, REDIS_WORKER_STATUS_SET, \
-                        REDIS_DRAMATIQ_QUEUE, REVIEWS_KEY, \
-                        LMDB_MAP_SIZE, REDIS_WORKER_STARTED
+                        REDIS_DRAMATIQ_QUEUE, REDIS_DRAMATIQ_BULK_QUEUE, REDIS_BULK_TASK_QUEUE_NAME, REDIS_TASK_STATE_PREFIX, REDIS_TASK_SEQ, \
+                        REDIS_TASK_DURATIONS, REVIEWS_KEY, \
+                        REDIS_WORKER_STARTED
 from ..logger import logger
 from ..session import session
+from ..statistics import statistics
 from ..utils import random_company
 from ..companydb import update_company, check_by_oid, get_by_oid, dbsearch, dbtruncate, make_connection
 from ..db import db
+from ..graphcrawl import GraphCrawler, COMPANY, USER
+from ..ratelimit import reviews_api, profile_api
+from ..lmdbenv import lmdb_get, write_txn, prefix_iter
+from ..userrecord import encode_user, decode_user, is_binary
 
 def countdown(n=5):
     for i in range(n, 0, -1):
@@ -75,10 +80,12 @@ def findnew():
 
     # read random user
     cl = CompanyList()
-    files = [f for f in settings.user_storage.iterdir() if f.is_file()]
 
     while not found:
-        uid = random.choice(files).name.split('-')[0]
+        uid = random_user()
+        if uid is None:
+            print("No users in LMDB")
+            return
         u = User(uid)
         for r in u.reviews():
             print(r)
@@ -280,37 +287,70 @@ def lmdb_dump(args):
 
     print("Dump", lmdb_path)
 
-    env = lmdb.open(lmdb_path, readonly=True, map_size=LMDB_MAP_SIZE)
+    def decode(key: bytes, val: bytes):
+        if key.startswith(b'user:'):
+            return decode_user(key[5:].decode(), val)
+        return json.loads(val.decode())
 
     if needle is None:
         # dump everything
-        with env.begin() as txn:
-            with txn.cursor() as cur:
-                for key, val in cur:
-                    data = json.loads(val.decode())
-                    print(key.decode())
-                    print_json(data=data)
-
-    elif needle.startswith('user:') or needle.startswith('objects:'):
+        for key, val in prefix_iter(b''):
+            data = decode(key, val)
+            print(key.decode())
+            print_json(data=data)
+
+    elif needle.startswith(('user:', 'usermeta:', 'objects:')):
         # dump specific key
-        with env.begin() as txn:
-            with txn.cursor() as cur:
-                for key, val in cur:
-                    if key.decode() == needle:
-                        data = json.loads(val.decode())
-                        print(key.decode())
-                        print_json(data=data)
+        val = lmdb_get(needle.encode())
+        if val:
+            data = decode(needle.encode(), val)
+            print(needle)
+            print_json(data=data)
 
     else:
         # dump company by name
-        with env.begin() as txn:
-            with txn.cursor() as cur:
-                for key, val in cur:
-                    if key.startswith(b'object:'):
-                        data = json.loads(val.decode())
-                        if needle is None or needle.lower() in data['name']:
-                            print(key.decode())
-                            print_json(data=data)
+        for key, val in prefix_iter(b'object:'):
+            data = json.loads(val.decode())
+            if needle is None or needle.lower() in data['name']:
+                print(key.decode())
+                print_json(data=data)
+
+
+def lmdb_convert(batch: int = 1000):
+    """ re-encode all user: records in compact binary format """
+
+    nusers = User.nusers()
+    converted = 0
+    processed = 0
+    started = time.time()
+    key = b'user:'
+
+    while True:
+        # read batch, then write it in one transaction
+        chunk = list()
+        for key, val in prefix_iter(b'user:', start=key):
+            if len(chunk) >= batch:
+                break
+            chunk.append((key, val))
+        else:
+            key = None
+
+        with write_txn() as txn:
+            for k, val in chunk:
+                if is_binary(val):
+                    continue
+                reviews = json.loads(val)
+                user_name = reviews[0].get('user_name') if reviews else None
+                txn.put(k, encode_user(user_name, reviews))
+                converted += 1
+
+        processed += len(chunk)
+        print(f"{processed}/{nusers} users processed, {converted} converted")
+
+        if key is None:
+            break
+
+    print(f"Done in {int(time.time() - started)} sec. Use 'mdb_copy -c' to compact database file")
 
 
 def get_args():
@@ -326,7 +366,7 @@ def get_args():
 
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("cmd", choices=['company-users', 'users', 'user-reviews', 'company-reviews', 'queue', 'explore', 'provider', 'sys', 'filldb', 'dev', 'lmdb', 'convert', 'delkeys', 'lmdbrm'])
+    parser.add_argument("cmd", choices=['company-users', 'users', 'user-reviews', 'company-reviews', 'queue', 'explore', 'crawl', 'provider', 'sys', 'filldb', 'dev', 'lmdb', 'convert', 'delkeys', 'lmdbrm'])
     parser.add_argument("-v", "--verbose", default=False, action='store_true')
     parser.add_argument("--full", default=False, action='store_true')
     parser.add_argument("args", nargs='*', help='extra args')
@@ -340,6 +380,10 @@ def get_args():
     g.add_argument("--noreport", default=None, action='store_true', help="Company has NO antifraud report")
     g.add_argument("--really", default=None, action='store_true', help="Really. (flag for dangerous commands like wipe)")
     
+    g = parser.add_argument_group('Crawl options')
+    g.add_argument("--depth", metavar='N', type=int, default=None, help="crawl: do not go deeper than N steps from start companies")
+    g.add_argument("--reset", default=False, action='store_true', help="crawl: forget crawl queue and visited nodes")
+
     g = parser.add_argument_group('Fraud options')
     g.add_argument("-s", "--show", metavar='N', type=int, help="Show links with N hits")
     g.add_argument("--overwrite", default=None, action='store_true', help="Recalculate even if fraud report exists")
@@ -376,8 +420,7 @@ def main():
 
     elif cmd == "lmdbrm":
         key = args.args[0].encode()
-        env = lmdb.open(settings.lmdb_storage.as_posix(), map_size=LMDB_MAP_SIZE)
-        with env.begin(write=True) as txn:
+        with write_txn() as txn:
             deleted = txn.delete(key)
             print(f"Deleted ({deleted}) {key}")
 
@@ -392,6 +435,10 @@ def main():
         if 'reset' in args.args:
             print("RESET queue")
             r.delete(REDIS_TASK_QUEUE_NAME)
+            r.delete(REDIS_BULK_TASK_QUEUE_NAME)
+            r.delete(REDIS_TASK_SEQ)
+            for key in r.scan_iter(REDIS_TASK_STATE_PREFIX + "*"):
+                r.delete(key)
             r.delete(REDIS_TRUSTED_LIST)
             r.delete(REDIS_UNTRUSTED_LIST)
             for key in r.scan_iter("dramatiq:*"):
@@ -412,23 +459,41 @@ def main():
         else:
             wuptime = None
         
-        tasks = r.lrange(REDIS_TASK_QUEUE_NAME, 0, -1)  # возвращает list of bytes    
+        lastn = 5
+
+        tasks = r.zrange(REDIS_TASK_QUEUE_NAME, 0, lastn - 1)
+        ntasks = r.zcard(REDIS_TASK_QUEUE_NAME)
+        bulk_tasks = r.zrange(REDIS_BULK_TASK_QUEUE_NAME, 0, lastn - 1)
+        nbulk_tasks = r.zcard(REDIS_BULK_TASK_QUEUE_NAME)
+        durations = [ float(d) for d in r.lrange(REDIS_TASK_DURATIONS, 0, -1) ]
         trusted_len = r.llen(REDIS_TRUSTED_LIST)
         untrusted_len = r.llen(REDIS_UNTRUSTED_LIST)
         dqlen = r.llen(REDIS_DRAMATIQ_QUEUE)
+        bulk_dqlen = r.llen(REDIS_DRAMATIQ_BULK_QUEUE)
 
         last_trusted = [json.loads(item) for item in r.lrange(REDIS_TRUSTED_LIST, 0, -1)]
         last_untrusted = [json.loads(item) for item in r.lrange(REDIS_UNTRUSTED_LIST, 0, -1)]
 
-        lastn = 5
-
         print("Queue report")
         print(f"Worker status: {wstatus} ({wstatus_age} sec ago)")
         print(f"Worker uptime: {wuptime} sec.")
-        print(f"Dramatiq queue: {dqlen}")
-        tasks_suffix = '...' if len(tasks) > lastn else ''
+        print(f"Dramatiq queues: interactive {dqlen} bulk {bulk_dqlen}")
+        for endpoint in (reviews_api, profile_api):
+            cstate = endpoint.breaker.state()
+            retry_in = f" retry in {cstate['retry_in']}s" if 'retry_in' in cstate else ''
+            print(f"API {endpoint.name}: circuit {cstate['state']}{retry_in} (errors in a row: {cstate['failures']})")
+        tasks_suffix = '...' if ntasks > lastn else ''
+        bulk_suffix = '...' if nbulk_tasks > lastn else ''
             
-        print(f"Tasks ({len(tasks)}): {' '.join(tasks[:lastn])} {tasks_suffix}")
+        print(f"Tasks ({ntasks}): {' '.join(tasks)} {tasks_suffix}")
+        print(f"Bulk tasks ({nbulk_tasks}): {' '.join(bulk_tasks)} {bulk_suffix}")
+        if durations:
+            print(f"Last {len(durations)} tasks: avg {sum(durations) / len(durations):.0f} sec, max {max(durations):.0f} sec")
+        for key in r.scan_iter(REDIS_TASK_STATE_PREFIX + "*"):
+            tstate = r.hgetall(key)
+            if tstate.get('state') == 'running':
+                print(f"Running: {key[len(REDIS_TASK_STATE_PREFIX):]} ({tstate.get('queue')}, "
+                      f"{int(time.time()) - int(tstate.get('started', 0))} sec)")
         print(f"Trusted ({lastn}/{trusted_len}):")
         for c in last_trusted[:lastn]:
             # print_json(data=c)
@@ -479,6 +544,7 @@ def main():
         data = r.json()
         print(f"Meta code: {data['meta']['code']}, rating:{data['meta']['branch_rating']} count: {data['meta']['branch_reviews_count']}/{data['meta']['total_count']}")
         print(f"Reviews: {len(data['reviews'])}")
+        print(statistics.http_summary())
 
     elif cmd == "filldb":
 
@@ -519,6 +585,7 @@ def main():
 
             cooldown_queue(10)
 
+            new_reviews = list()
             for rev in u.reviews():
                 if rev.get_town().lower() != town:
                     continue
@@ -527,30 +594,59 @@ def main():
                     # logger.info(f"Skip nocompany (in db) {rev.oid} {rev.title}")
                     continue
 
-                if not cl.company_exists(rev.oid):
-                    cooldown_queue(10)
-                    try:
-                        c = Company(rev.oid)
-                    except (AFNoCompany, AFNoTitle) as e:
-                        # logger.info(f"AFNoCompany {rev.oid} {rev.title}")
-                        db.add_nocompany(rev.oid)
-                        continue
+                if not cl.company_exists(rev.oid) and rev.oid not in (r.oid for r in new_reviews):
+                    new_reviews.append(rev)
 
-                    logger.info(f"{submitted}: new company {rev.get_town()} {rev.oid} {rev.title}")
-                    submit_fraud_task(rev.oid)
+            if new_reviews:
+                cooldown_queue(10)
+                # load all new companies of this user in parallel
+                companies = prefetch_companies(rev.oid for rev in new_reviews)
 
-                    submitted += 1
+            for rev in new_reviews:
+                if isinstance(companies[rev.oid], (AFNoCompany, AFNoTitle, AFCompanyError)):
+                    # logger.info(f"AFNoCompany {rev.oid} {rev.title}")
+                    db.add_nocompany(rev.oid)
+                    continue
+                if isinstance(companies[rev.oid], Exception):
+                    # network error, company is not marked, will be found again
+                    continue
+
+                logger.info(f"{submitted}: new company {rev.get_town()} {rev.oid} {rev.title}")
+                submit_fraud_task(rev.oid, bulk=True)
 
-                    if submitted % 20 == 0:
-                        reset_user_pool()
+                submitted += 1
 
-                if stopfile.exists():
-                    logger.info("Stopfile found, exit")
-                    stopfile.unlink()
-                    return
+                if submitted % 20 == 0:
+                    reset_user_pool()
+
+            if stopfile.exists():
+                logger.info("Stopfile found, exit")
+                stopfile.unlink()
+                return
         else:
             print(f"Finished. Last used: {idx} submitted: {submitted}")
 
+    elif cmd == "crawl":
+        # af2dev crawl [-t TOWN] [--depth N] [-l N] [OID ...]
+        if args.reset:
+            GraphCrawler.reset()
+            print("Crawl queue is empty now")
+
+        gc = GraphCrawler(town=args.town, maxdepth=args.depth)
+        added = gc.seed(COMPANY, args.args)
+        if not args.args and not gc.qsize():
+            uid = random_user()
+            if uid is None:
+                print("Nothing to crawl, give start company OIDs")
+                return
+            print(f"Start from random user {uid}")
+            added = gc.seed(USER, [ uid ])
+
+        print(f"Crawl queue: {gc.qsize()} nodes (new {added}), visited: {gc.nseen()}")
+        gc.run(limit=args.limit, stopfile=stopfile)
+        print(f"Processed {gc.processed} nodes, queued {gc.queued}, failed {gc.failed}, in queue: {gc.qsize()}")
+        print(statistics)
+
     elif cmd == "dev":
         return
 
@@ -597,13 +693,7 @@ def main():
 
 
     elif cmd == "convert":
-        nusers = User.nusers()
-        env = lmdb.open(settings.lmdb_storage.as_posix(), map_size=LMDB_MAP_SIZE)
-        
-        with env.begin(write=True) as txn:
-            for idx, u in enumerate(User.users()):
-                print(f"{idx}/{nusers} {u.public_id}")
-                u.lmdb_save(txn=txn)
+        lmdb_convert()
 
         
 
@@ -59,7 +59,7 @@ def get_args():
     aa.parse()
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("cmd", choices=['info', 'list','stop','summary', 'fraud', 'compare', 'submitfraud', 'delreport', 'wipe', 'export', 'search', 'aliases'])
+    parser.add_argument("cmd", choices=['info', 'list','stop','summary', 'fraud', 'compare', 'submitfraud', 'delreport', 'wipe', 'export', 'search', 'aliases', 'refresh'])
     parser.add_argument("-v", "--verbose", default=False, action='store_true')
     parser.add_argument("--sleep", type=float, default=None, help='sleep N.M seconds after each processed company')
     parser.add_argument("--fmt", "-f", default="normal", choices=['brief', 'normal', 'full'])
@@ -79,7 +79,7 @@ def get_args():
     g.add_argument("-s", "--show", metavar='N', type=int, help="Show links with N hits")
     g.add_argument("--overwrite", default=None, action='store_true', help="Recalculate even if fraud report exists")
     g.add_argument("--explain", default=False, action='store_true', help="Re-run fraud detection with explanation")
-    g.add_argument("--maxq", metavar='N', default=None, type=int, help="Sleep if redis queue is over N")
+    g.add_argument("--maxq", metavar='N', default=None, type=int, help="Sleep if bulk redis queue is over N")
 
     return parser.parse_args()
 
@@ -157,10 +157,10 @@ def main():
             print("total:", len(res))
         
 
-    elif args.cmd in ["list", "fraud", "delreport", "wipe", "submitfraud", "export"]:
+    elif args.cmd in ["list", "fraud", "delreport", "wipe", "submitfraud", "export", "refresh"]:
 
         # sanity check
-        if args.cmd in ["submitfraud", "fraud", "delreport", "wipe"] and not any_filter(args):
+        if args.cmd in ["submitfraud", "fraud", "delreport", "wipe", "refresh"] and not any_filter(args):
             if len(args.args) == 1:
                 args.company = args.args[0]
             else:
@@ -218,7 +218,7 @@ def main():
                 if args.maxq:
                     cooldown_queue(args.maxq)
                 print("submit fraud request for", c)
-                submit_fraud_task(oid = c.object_id, force=args.overwrite)
+                submit_fraud_task(oid = c.object_id, force=args.overwrite, bulk=True)
 
 
             elif args.cmd == "delreport":                
@@ -239,6 +239,15 @@ def main():
 
             elif args.cmd == "export":
                 _print(json.dumps(c.export()))
+
+            elif args.cmd == "refresh":
+                if c.frozen:
+                    print(f"skip frozen {c}")
+                else:
+                    nnew = c.refresh_reviews()
+                    print(f"{c}: {nnew} new reviews")
+                    if nnew and c.report_path.exists():
+                        print(f"  report is outdated, recalculate: af2gis fraud --overwrite {c.object_id}")
             
             # Stop if stopfile
             if stopfile.exists():
@@ -5,7 +5,6 @@ from rich.table import Table
 import time
 import sys
 import re
-import lmdb
 from pathlib import Path
 
 from collections import defaultdict
@@ -13,12 +12,12 @@ from collections import defaultdict
 
 from ..logger import logger
 
-from ..const import LMDB_MAP_SIZE
 from ..company import Company, CompanyList
 from ..fraud import detect
 from ..db import db
 from ..settings import settings
 from ..user import User
+from ..lmdbenv import prefix_iter
 
 def add_summary_parser(subparsers):
     sum_parser = subparsers.add_parser("summary", help="Operations with whole database")
@@ -49,14 +48,11 @@ def printsummary(cl: CompanyList, full=False):
 
     logger.info(f"SUMMARY Companies: {total=}, {nerr=} {ncalc=} {nncalc=}")
     
-    env = lmdb.open(settings.lmdb_storage.as_posix(), readonly=True, map_size=LMDB_MAP_SIZE)
     prefixes = defaultdict(int)
-    with env.begin() as txn:
-        with txn.cursor() as cur:
-            for key, val in cur:
-                keyprefix = key.decode().split(':')[0]
-                prefixes[keyprefix] += 1
-                #print(keyprefix)
+    for key, val in prefix_iter(b''):
+        keyprefix = key.decode().split(':')[0]
+        prefixes[keyprefix] += 1
+        #print(keyprefix)
     logger.info(f"SUMMARY LMDB prefixes: {dict(prefixes)}")
 
 
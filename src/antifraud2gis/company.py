@@ -6,8 +6,9 @@ import sys
 import gzip
 import zlib
 import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import lmdb
 import redis
 from rich.progress import Progress
 from rich import print_json
@@ -16,16 +17,23 @@ from requests.exceptions import RequestException
 from typing import Generator
 
 from .settings import settings
-from .const import DATAFORMAT_VERSION, SLEEPTIME, WSS_THRESHOLD, LOAD_NREVIEWS, REVIEWS_KEY, LMDB_MAP_SIZE
-from .user import User, get_user
+from .const import DATAFORMAT_VERSION, SLEEPTIME, WSS_THRESHOLD, LOAD_NREVIEWS, REVIEWS_KEY
+from .lmdbenv import lmdb_get, lmdb_getmulti
+from .user import User, get_user, load_users, stale_users, forget_users
+from .crawler import crawl_users
 from .review import Review
 from .session import session
-from .exceptions import AFNoCompany, AFNoTitle, AFCompanyError, AFCompanyNotFound
+from .exceptions import AFNoCompany, AFNoTitle, AFCompanyError, AFCompanyNotFound, AFNetworkError
 from .aliases import resolve_alias
 from .statistics import statistics
 from .aliases import aliases, resolve_alias
 from .db import db
 from .companydb import dbsearch
+from .utils import LRUCache, date_to_day, today, next_page_url, same_url
+from .ratelimit import reviews_api, is_throttled, retry_after
+
+# process-wide cache of LMDB object: records, oid -> (title, address)
+object_cache = LRUCache(maxsize=settings.object_cache_size)
 
 # to avoid circular import
 #class RelationDict:
@@ -177,7 +185,7 @@ class Company:
             json.dump(basic, f)
 
             if not self.loaded_from_disk:
-                statistics.created_new_companies += 1
+                statistics.inc(created_new_companies=1)
 
 
 
@@ -190,15 +198,41 @@ class Company:
                 with gzip.open(self.reviews_path, "rt") as f:
                     # print(f"Load company reviews from {self.reviews_path} mtime: {int(self.reviews_path.stat().st_mtime)} sz: {self.reviews_path.stat().st_size}")
                     self._reviews = json.load(f)
+                    self.set_days()
                     self.count_rate()
             except (gzip.BadGzipFile, OSError, zlib.error):
                 logger.error(f"Bad gzip file! {self.reviews_path}")
                 sys.exit(1)
+
+            if not local_only and self.is_stale():
+                try:
+                    self.refresh_reviews()
+                except (AFNetworkError, RequestException) as e:
+                    logger.warning(f"Company {self.object_id}: cannot refresh reviews, use cached: {e}")
         else:
             if not local_only:
                 self.load_reviews_from_network()
         return len(self._reviews)
 
+    def reviews_age(self) -> float:
+        """ days since reviews were loaded/refreshed from network, None if not loaded """
+        if not self.reviews_path.exists():
+            return None
+        return (time.time() - self.reviews_path.stat().st_mtime) / 86400
+
+    def is_stale(self) -> bool:
+        """ cached reviews are older than settings.company_stale_days (0 - never stale) """
+        if not settings.company_stale_days or self.frozen:
+            return False
+        age = self.reviews_age()
+        return age is not None and age > settings.company_stale_days
+
+    def set_days(self):
+        """ parse date_created once, reviews (and reviews file) keep it as created_day """
+        for r in self._reviews:
+            if 'created_day' not in r:
+                r['created_day'] = date_to_day(r['date_created'])
+
     def count_rate(self):
         self.ratings = list()
         for r in self._reviews:
@@ -234,6 +268,21 @@ class Company:
     def load_users(self, until_resolve=False):
         self.load_reviews()
         # print(f"load users from {len(self._reviews)} reviews")
+
+        if not until_resolve:
+            # users already in LMDB are read in one go, missing users are crawled concurrently,
+            # users which crawler failed to load are loaded one by one below
+            uids = list(self.uids())
+            # stored users fetched long ago: load only their new reviews
+            stale = stale_users(uids)
+            if stale:
+                crawl_users(stale, update=True)
+                forget_users(stale)
+            missing = set(uids) - load_users(uids).keys()
+            if missing:
+                crawl_users(missing)
+                load_users(missing)
+
         with Progress() as progress:
             task = progress.add_task("[cyan]Loading user's reviews...", total=len(self._reviews))
 
@@ -257,33 +306,167 @@ class Company:
                         # print("resolved!", title, address)
                         return
 
+    def _get_page(self, url: str):
+        """ GET one page of reviews with bounded retries, paced by reviews_api limits """
+        if ':8080' in url:
+            logger.debug(f'strip :8080 from {url}')
+            url = url.replace(':8080', '')
+
+        error = None
+        for attempt in range(settings.network_retries):
+            reviews_api.before()
+            try:
+                r = session.get(url)
+            except RequestException as e:
+                print("RequestException", e)
+                reviews_api.failed()
+                error = e
+                continue
+
+            if is_throttled(r):
+                # last attempt too: throttled response is a failure, not returned to caller
+                logger.debug(f"company {self.object_id} reviews: {r.status_code}, retry")
+                reviews_api.failed(retry_after(r))
+                error = f"HTTP {r.status_code}"
+                continue
+
+            reviews_api.ok()
+            return r
+
+        raise AFNetworkError(f"Cannot load {url} after {settings.network_retries} attempts: {error}")
+
+    def iter_pages(self, url: str, prefetch: int = None):
+        """ yield responses for url and next pages
+
+            next pages are predicted from offset in next_link and requested ahead (settings.page_prefetch)
+            while current page is processed. If prediction is wrong, next_link is requested.
+            prefetch=0: no requests ahead, next page is requested only when caller asks for it
+        """
+        if prefetch == 0:
+            while url:
+                r = self._get_page(url)
+                yield r
+                url = r.json()['meta'].get('next_link') if r.status_code == 200 else None
+            return
+
+        depth = max(1, settings.page_prefetch if prefetch is None else prefetch)
+        pool = ThreadPoolExecutor(max_workers=depth)
+        pending = deque([ (url, pool.submit(self._get_page, url)) ])
+        # do not predict pages after end
+        max_offset = LOAD_NREVIEWS
+
+        try:
+            while pending:
+                url, future = pending.popleft()
+                r = future.result()
+                next_link = None
+                if r.status_code == 200:
+                    meta = r.json()['meta']
+                    next_link = meta.get('next_link')
+                    max_offset = min(max_offset, meta.get('total_count') or max_offset)
+
+                if pending and not (next_link and same_url(next_link, pending[0][0])):
+                    # wrong prediction
+                    for _, f in pending:
+                        f.cancel()
+                    pending.clear()
+
+                if next_link and not pending:
+                    pending.append((next_link, pool.submit(self._get_page, next_link)))
+
+                # keep depth pages in flight
+                while pending and len(pending) < depth:
+                    predicted = next_page_url(pending[-1][0], max_offset)
+                    if predicted is None:
+                        break
+                    pending.append((predicted, pool.submit(self._get_page, predicted)))
+
+                logger.debug(f'next_link: {next_link}')
+                yield r
+        finally:
+            for _, f in pending:
+                f.cancel()
+            pool.shutdown(wait=False)
+
+    def reviews_url(self, sort_by: str = 'friends'):
+        return f'{settings.reviews_api_url}/branches/{self.object_id}/reviews?limit=50&fields=meta.providers,meta.branch_rating,meta.branch_reviews_count,meta.total_count,reviews.hiding_reason,reviews.is_verified&without_my_first_review=false&rated=true&sort_by={sort_by}&key={REVIEWS_KEY}&locale=ru_RU'
+
+    def save_reviews(self):
+        with gzip.open(self.reviews_path, 'wt') as f:
+            json.dump(self._reviews, f)
+
+    def refresh_reviews(self) -> int:
+        """ delta refresh: load only reviews newer than cached ones and merge them. returns number of new reviews
+
+            pages are requested newest first (sort_by=date_created) until page with known review
+            (or review older than newest cached one), so usually it costs one or two pages.
+        """
+        if not self._reviews:
+            self.load_reviews(local_only=True)
+        if not self._reviews:
+            self.load_reviews_from_network()
+            return len(self._reviews)
+
+        known = set(r['id'] for r in self._reviews)
+        newest = max(r['date_created'] for r in self._reviews)
+        new_reviews = list()
+        npages = 0
+
+        # one page is usually enough, do not request pages ahead
+        for npages, r in enumerate(self.iter_pages(self.reviews_url(sort_by='date_created'), prefetch=0), start=1):
+            if r.status_code == 400:
+                logger.warning(f"Company {self.object_id}: bad request on refresh {r.url}")
+                break
+            r.raise_for_status()
+            data = r.json()
+
+            if npages == 1:
+                self.total_count_2gis = data['meta']['total_count']
+                self.branch_count_2gis = data['meta']['branch_reviews_count']
+                self.branch_rating_2gis = data['meta']['branch_rating']
+
+            reached_cached = False
+            for review in data['reviews']:
+                if review['id'] in known or review['date_created'] < newest:
+                    reached_cached = True
+                    continue
+                known.add(review['id'])
+                new_reviews.append(review)
+
+            if reached_cached or len(new_reviews) >= LOAD_NREVIEWS or not data['meta'].get('next_link'):
+                break
+
+        if new_reviews:
+            self._reviews = new_reviews + self._reviews
+            self.set_days()
+            if len(self._reviews) > LOAD_NREVIEWS:
+                # keep newest
+                self._reviews = sorted(self._reviews, key=lambda r: r['created_day'], reverse=True)[:LOAD_NREVIEWS]
+            self.count_rate()
+
+        logger.info(f"Company {self.object_id}: refreshed, {len(new_reviews)} new reviews from {npages} pages")
+
+        # rewrite even if nothing new: mtime is refresh time
+        self.save_reviews()
+        self.save_basic()
+        statistics.inc(total_companies_loaded_network=1)
+        return len(new_reviews)
+
     def load_reviews_from_network(self):
-        url = f'https://public-api.reviews.2gis.com/2.0/branches/{self.object_id}/reviews?limit=50&fields=meta.providers,meta.branch_rating,meta.branch_reviews_count,meta.total_count,reviews.hiding_reason,reviews.is_verified&without_my_first_review=false&rated=true&sort_by=friends&key={REVIEWS_KEY}&locale=ru_RU'
+        url = self.reviews_url()
         unused_geo = f'https://public-api.reviews.2gis.com/2.0/geo/141373143684284/reviews?limit=50&fields=meta.providers,meta.geo_rating,meta.geo_reviews_count,meta.total_count,reviews.hiding_reason&sort_by=friends&without_my_first_review=false&key={REVIEWS_KEY}&locale=ru_RU'
 
         # print("LOAD NETWORK REVIEWS", self.object_id)
 
-        page=0
-        while url:
-            if ':8080' in url:
-                logger.debug(f'strip :8080 from {url}')
-                url = url.replace(':8080', '')
-            logger.debug(f".. load company reviews p{page} for {self}: {url}")
-            r = None
-            while r is None:
-
-                try:                    
-                    r = session.get(url)
-                except RequestException as e:
-                    print("RequestException", e)
-                    time.sleep(1)
+        for page, r in enumerate(self.iter_pages(url)):
+            logger.debug(f".. loaded company reviews p{page} for {self}: {r.url}")
             
             #print(r.status_code)
             #print(r)
             #print(r.text)
 
             if r.status_code == 400:
-                print("bad request", url)
+                print("bad request", r.url)
                 self.save_basic()
                 break
 
@@ -306,29 +489,25 @@ class Company:
             # print(f"{self.object_id} page {page} first: {data['reviews'][0]['date_created']} last: {data['reviews'][-1]['date_created']}")
 
             self._reviews.extend(data['reviews'])
-            url = data['meta'].get('next_link')
-            logger.debug(f'next_link: {url}')
-            time.sleep(SLEEPTIME)
 
             if len(self._reviews) >= LOAD_NREVIEWS:
                 # print(f"max reviews {len(self._reviews)} reached")
                 break
 
-            page+=1
+            if not data['meta'].get('next_link'):
+                break
         
 
         logger.info(f"Company {self.object_id}: loaded from network {len(self._reviews)} reviews")
+        self.set_days()
         # why we were called?
         # print("----------")
         # print("".join(traceback.format_stack(limit=10)))         
 
         self.count_rate()
+        self.save_reviews()
 
-        with gzip.open(self.reviews_path, 'wt') as f:
-            json.dump(self._reviews, f)
-
-        statistics.total_companies_loaded+=1
-        statistics.total_companies_loaded_network+=1
+        statistics.inc(total_companies_loaded=1, total_companies_loaded_network=1)
 
     def risk(self):
         if not self.score:
@@ -395,11 +574,11 @@ class Company:
         return data
 
     def reviews(self):
+        min_day = today() - settings.max_review_age
         for r in self._reviews:
-            rev = Review(r, company=self)
-            if rev.age > settings.max_review_age:
+            if r['created_day'] < min_day:
                 continue
-            yield rev
+            yield Review(r, company=self)
 
     def nreviews(self, provider = None):
 
@@ -407,9 +586,9 @@ class Company:
             return len(self._reviews)
         # count reviews now myself
         n = 0
+        min_day = today() - settings.max_review_age
         for rev in self._reviews:
-            r = Review(rev, company=self)
-            if r.age > settings.max_review_age:
+            if rev['created_day'] < min_day:
                 continue
 
             if provider == '*' or rev['provider'] == provider:
@@ -490,17 +669,40 @@ class Company:
     @staticmethod
     def resolve_oid(object_id: str):
         """ set self.title/address from user's reviews """
-        # env = lmdb.open(settings.lmdb_storage.as_posix(), map_size=LMDB_MAP_SIZE, readonly=True)
-        env = lmdb.open(settings.lmdb_storage.as_posix(), readonly=True)
-
-        with env.begin() as txn:
-            jdata = txn.get(b"object:" + object_id.encode())
-            if jdata:
-                data = json.loads(jdata)
-                return data['name'], data['address']
+        objinfo = object_cache.get(object_id)
+        if objinfo:
+            return objinfo
+
+        jdata = lmdb_get(b"object:" + object_id.encode())
+        if jdata:
+            data = json.loads(jdata)
+            objinfo = (data['name'], data['address'])
+            object_cache.put(object_id, objinfo)
+            return objinfo
+        else:
+            raise AFCompanyNotFound(f'Company {object_id} not found in LMDB')
+
+
+    @staticmethod
+    def resolve_oids(object_ids) -> dict:
+        """ bulk resolve_oid: returns dict oid -> (title, address) for oids found in LMDB """
+        result = dict()
+        missing = list()
+        for oid in object_ids:
+            objinfo = object_cache.get(oid)
+            if objinfo:
+                result[oid] = objinfo
             else:
-                raise AFCompanyNotFound(f'Company {object_id} not found in LMDB')
+                missing.append(oid)
+
+        found = lmdb_getmulti(b"object:" + oid.encode() for oid in missing)
 
+        for key, jdata in found.items():
+            data = json.loads(jdata)
+            oid = key[7:].decode()
+            result[oid] = (data['name'], data['address'])
+            object_cache.put(oid, result[oid])
+        return result
 
     def update_title(self):
         """ set self.title/address from user's reviews """
@@ -535,6 +737,25 @@ class Company:
                 
         return True
 
+def prefetch_companies(oids) -> dict:
+    """ Company() for many oids in parallel, so network loads of new companies overlap
+
+        returns oid -> Company, or exception if company cannot be created: AFNoCompany, AFNoTitle, AFCompanyError
+        (not a company), AFNetworkError or RequestException (may be retried later)
+    """
+    def make(oid):
+        try:
+            return Company(oid)
+        except (AFNoCompany, AFNoTitle, AFCompanyError) as e:
+            return e
+        except (AFNetworkError, RequestException) as e:
+            logger.warning(f"Cannot load company {oid}: {e}")
+            return e
+
+    oids = list(dict.fromkeys(oids))
+    with ThreadPoolExecutor(max_workers=max(1, settings.company_prefetch)) as pool:
+        return dict(zip(oids, pool.map(make, oids)))
+
 class CompanyList():
     path = None
     def __init__(self, path=None):
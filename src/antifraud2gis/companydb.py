@@ -70,6 +70,23 @@ def get_by_oid(oid: str, conn = None) -> Optional[dict]:
     col_names = [desc[0] for desc in cursor.description]
     return dict(zip(col_names, row))
 
+def get_by_oids(oids, conn = None) -> dict[str, dict]:
+    """ bulk get_by_oid, returns dict oid -> row for found oids """
+    conn = conn or make_connection()
+    cursor = conn.cursor()
+    oids = list(oids)
+    result = dict()
+
+    # stay below SQLITE_MAX_VARIABLE_NUMBER
+    for start in range(0, len(oids), 500):
+        chunk = oids[start:start + 500]
+        cursor.execute(f"SELECT * FROM company WHERE oid IN ({','.join('?' * len(chunk))})", chunk)
+        col_names = [desc[0] for desc in cursor.description]
+        for row in cursor.fetchall():
+            rec = dict(zip(col_names, row))
+            result[rec['oid']] = rec
+    return result
+
 def dbsearch(query: str, addr: str = None, limit=None, nreviews=None, detection=None, conn = None) -> list[dict]:
 
     limit = 100 if limit is None else int(limit)
@@ -0,0 +1,73 @@
+from typing import Optional
+
+from .company import Company
+from .companydb import get_by_oids
+from .aliases import aliases
+from .db import db
+
+"""
+    Read-only company info for rendering reports (relation rows).
+
+    Unlike Company(), it never reads/writes basic files, never loads reviews or users and never goes to network:
+    title/town/trusted are taken from SQLite (companydb), title/address of companies not yet in SQLite
+    from LMDB object: records, alias/tags from aliases.
+"""
+
+
+class CompanyInfo:
+
+    object_id: str
+    title: Optional[str]
+    address: Optional[str]
+    town: Optional[str]
+    alias: Optional[str]
+    tags: Optional[str]
+    trusted: Optional[bool]
+
+    def __init__(self, object_id: str, title: str = None, address: str = None, town: str = None, trusted: bool = None):
+        self.object_id = object_id
+        self.title = title
+        self.address = address
+        self.town = town if town is not None else self._town(address)
+        self.alias = aliases.get(object_id, {}).get('alias')
+        self.tags = aliases.get(object_id, {}).get('tags')
+        self.trusted = trusted
+
+    @staticmethod
+    def _town(address: str) -> Optional[str]:
+        if address is None:
+            return None
+        return address.split(',')[0].replace(u'\xa0', u' ')
+
+    def get_title(self):
+        return self.title or self.object_id
+
+    def get_town(self):
+        return self.town
+
+    def __repr__(self):
+        return f"CompanyInfo({self.object_id} {self.title!r} town: {self.town} trusted: {self.trusted})"
+
+    @staticmethod
+    def lookup_many(oids) -> dict[str, 'CompanyInfo']:
+        """ CompanyInfo for each oid, except not-a-company oids (non-digital or in db.nocompanies) """
+        oids = [ oid for oid in oids if oid.isdigit() and not db.is_nocompany(oid) ]
+        rows = get_by_oids(oids)
+        objinfo = Company.resolve_oids([ oid for oid in oids if oid not in rows ])
+
+        result = dict()
+        for oid in oids:
+            if oid in rows:
+                row = rows[oid]
+                trusted = None if row['trusted'] is None else bool(row['trusted'])
+                result[oid] = CompanyInfo(oid, title=row['title'], address=row['address'], town=row['town'], trusted=trusted)
+            elif oid in objinfo:
+                title, address = objinfo[oid]
+                result[oid] = CompanyInfo(oid, title=title, address=address)
+            else:
+                result[oid] = CompanyInfo(oid)
+        return result
+
+    @staticmethod
+    def lookup(oid: str) -> Optional['CompanyInfo']:
+        return CompanyInfo.lookup_many([oid]).get(oid)
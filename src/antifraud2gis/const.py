@@ -13,12 +13,22 @@ SUMMARY_PERIOD = 10*60
 # grep reviewApiKey in https://2gis.ru/ , see contrib/
 REVIEWS_KEY = '6e7e1929-4ea9-4a5d-8c05-d601860389bd'
 
-REDIS_TASK_QUEUE_NAME="af2gis:queue"
+# sorted sets oid -> submission seq
+REDIS_TASK_QUEUE_NAME="af2gis:zqueue"
+REDIS_BULK_TASK_QUEUE_NAME="af2gis:zbulkqueue"
+REDIS_TASK_SEQ="af2gis:queue_seq"
+REDIS_TASK_DURATIONS="af2gis:task_durations"
+REDIS_WORKER_CONCURRENCY="af2gis:worker_concurrency"
 REDIS_TRUSTED_LIST="af2gis:last_trusted_list"
 REDIS_UNTRUSTED_LIST="af2gis:last_untrusted_list"
 REDIS_WORKER_STATUS="af2gis:worker_status"
 REDIS_WORKER_STATUS_SET="af2gis:worker_status_set"
 REDIS_WORKER_STARTED="af2gis:worker_started"
 REDIS_DRAMATIQ_QUEUE="dramatiq:default"
+REDIS_DRAMATIQ_BULK_QUEUE="dramatiq:bulk"
+REDIS_RATELIMIT_PREFIX="af2gis:ratelimit:"
+REDIS_CIRCUIT_PREFIX="af2gis:circuit:"
+REDIS_INFLIGHT_PREFIX="af2gis:inflight:"
+REDIS_TASK_STATE_PREFIX="af2gis:task:"
 
 LMDB_MAP_SIZE = 1 << 36
@@ -0,0 +1,253 @@
+import asyncio
+import time
+import importlib.util
+from urllib.parse import urlparse
+
+import httpx
+
+from .db import db
+from .settings import settings
+from .session import session, record_connect, record_response
+from .statistics import statistics
+from .lmdbenv import write_txn
+from .user import save_user_reviews, get_usermeta, FeedPager
+from .ratelimit import profile_api, is_throttled, retry_after
+from .exceptions import AFNetworkError
+from .logger import logger
+
+"""
+    Concurrent crawler for user review feeds (content/feed API).
+
+    crawl_users(public_ids) fetches many users at once:
+        - at most settings.crawl_concurrency requests in flight, one shared httpx connection pool
+        - at most settings.crawl_rate requests per second to each host (HostRateLimiter)
+          and global profile API limits shared with other workers (ratelimit.profile_api)
+        - bounded queues: producer waits for free fetchers, fetchers wait for LMDB writer (back-pressure)
+        - fetched users are saved to LMDB in batches of settings.crawl_batch users per write transaction,
+          LMDB is accessed in executor threads, not in event loop
+        - error for one user is logged and counted (failed), LMDB write error stops whole crawl
+        - HTTP/2 if h2 is installed, connection/response timings go to statistics (like session.py)
+
+    Same result as User.load_from_network() for each user: reviews saved as user:<public_id> (and usermeta:),
+    403 means private profile (db.add_private_profile), 400/500 saves what was loaded before error.
+    Users failed with other errors are not saved, User.load() will retry them one by one.
+"""
+
+# HTTP/2 needs optional h2 package (pip install httpx[http2])
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+
+
+class HostRateLimiter:
+    """ allow at most rate requests per second to each host (0 - no limit) """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0
+        self._next = dict()
+        self._lock = asyncio.Lock()
+
+    async def wait(self, url: str):
+        if not self.interval:
+            return
+
+        host = urlparse(url).netloc
+        async with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next.get(host, now))
+            self._next[host] = slot + self.interval
+
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+async def _trace_request(request: httpx.Request):
+    """ httpx request hook: timing of new connections (same metrics as session.py) """
+    started = dict()
+    elapsed = dict()
+
+    async def trace(event: str, info: dict):
+        step, _, phase = event.rpartition('.')
+        if phase == 'started':
+            started[step] = time.monotonic()
+        elif phase == 'complete' and step in started:
+            elapsed[step] = time.monotonic() - started[step]
+            if step == 'connection.start_tls' or (step == 'connection.connect_tcp' and request.url.scheme == 'http'):
+                record_connect(elapsed.get('connection.connect_tcp', 0), elapsed.get('connection.start_tls', 0))
+
+    request.extensions['trace'] = trace
+    request.extensions['af2gis_started'] = time.monotonic()
+
+
+async def _trace_response(response: httpx.Response):
+    """ httpx response hook: called when headers are received (body not read yet) """
+    started = response.request.extensions.get('af2gis_started')
+    if started is not None:
+        record_response(time.monotonic() - started)
+
+
+class UserCrawler:
+
+    def __init__(self, concurrency: int = None, rate: float = None, batch: int = None):
+        self.concurrency = concurrency or settings.crawl_concurrency
+        self.batch = batch or settings.crawl_batch
+        self.limiter = HostRateLimiter(settings.crawl_rate if rate is None else rate)
+
+        # counters for last crawl
+        self.update = False
+        self.loaded = 0
+        self.private = 0
+        self.failed = 0
+
+    def make_client(self) -> httpx.AsyncClient:
+        # keep-alive connection for each fetcher, retry failed connects
+        transport = httpx.AsyncHTTPTransport(
+            proxy=settings.proxy,
+            http2=settings.http2 and HTTP2_AVAILABLE,
+            retries=settings.http_retries,
+            limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        )
+        return httpx.AsyncClient(
+            headers={ 'User-Agent': session.headers['User-Agent'] },
+            transport=transport,
+            timeout=httpx.Timeout(settings.http_timeout),
+            event_hooks={ 'request': [ _trace_request ], 'response': [ _trace_response ] }
+        )
+
+    async def fetch_user(self, client: httpx.AsyncClient, public_id: str, meta: dict = None):
+        """ returns FeedPager with loaded reviews or None for private profile. meta: update stored user """
+        url = settings.user_feed_url.format(public_id=public_id)
+        pager = FeedPager(public_id, meta=meta)
+
+        loop = asyncio.get_running_loop()
+        throttled = 0
+
+        while True:
+            # global (all workers) limits may block, wait for them in thread
+            await loop.run_in_executor(None, profile_api.before)
+            await self.limiter.wait(url)
+            try:
+                r = await client.get(url, params=pager.params())
+            except httpx.TransportError:
+                profile_api.failed()
+                raise
+
+            if r.status_code == 403:
+                profile_api.ok()
+                return None
+            elif r.status_code in [400, 500]:
+                logger.warning(f"user {public_id} reviews error {r.status_code} url: {r.url}")
+                pager.error()
+                break
+            elif is_throttled(r):
+                # last attempt too: throttled response is a failure
+                profile_api.failed(retry_after(r))
+                throttled += 1
+                if throttled > settings.network_retries:
+                    raise AFNetworkError(f"Cannot load user {public_id}: HTTP {r.status_code} "
+                                         f"after {settings.network_retries} retries")
+                continue
+            else:
+                r.raise_for_status()
+            profile_api.ok()
+
+            if not pager.add_page(r.json()):
+                break
+
+        return pager
+
+    async def _fetcher(self, client: httpx.AsyncClient, todo: asyncio.Queue, done: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            public_id = await todo.get()
+            if public_id is None:
+                return
+            try:
+                meta = None
+                if self.update:
+                    meta = await loop.run_in_executor(None, get_usermeta, public_id) or dict()
+                pager = await self.fetch_user(client, public_id, meta=meta)
+            except Exception as e:
+                # any error (not only network) must not stop fetcher: producer waits for free fetchers
+                logger.warning(f"crawler: cannot load user {public_id}: {type(e).__name__} {e}")
+                self.failed += 1
+                continue
+            await done.put((public_id, pager))
+
+    async def _producer(self, public_ids, todo: asyncio.Queue, nfetchers: int):
+        for public_id in public_ids:
+            await todo.put(public_id)
+        for _ in range(nfetchers):
+            await todo.put(None)
+
+    def _save(self, results: list):
+        with write_txn() as txn:
+            for public_id, pager in results:
+                if pager is not None:
+                    save_user_reviews(txn, public_id, pager.reviews, update=pager.update, page_token=pager.incomplete,
+                                      failed=pager.failed)
+
+        for public_id, pager in results:
+            if pager is None:
+                db.add_private_profile(public_id)
+                self.private += 1
+            else:
+                self.loaded += 1
+                statistics.inc(total_users_loaded_network=1, total_users_loaded=1)
+
+    async def _writer(self, done: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        results = list()
+        while True:
+            item = await done.get()
+            if item is not None:
+                results.append(item)
+            if results and (item is None or len(results) >= self.batch):
+                # LMDB write (may wait for other writers) in thread, fetchers keep working
+                await loop.run_in_executor(None, self._save, results)
+                results = list()
+            if item is None:
+                return
+
+    async def crawl_async(self, public_ids):
+        todo = asyncio.Queue(maxsize=self.concurrency * 2)
+        done = asyncio.Queue(maxsize=self.batch * 2)
+
+        async with self.make_client() as client:
+            writer = asyncio.create_task(self._writer(done))
+            fetchers = [ asyncio.create_task(self._fetcher(client, todo, done)) for _ in range(self.concurrency) ]
+            producer = asyncio.create_task(self._producer(public_ids, todo, len(fetchers)))
+            tasks = [ writer, producer, *fetchers ]
+            workers = asyncio.gather(producer, *fetchers)
+
+            try:
+                # writer can finish before workers only if it failed, then nobody reads done queue
+                await asyncio.wait([ workers, writer ], return_when=asyncio.FIRST_COMPLETED)
+                if writer.done():
+                    writer.result()
+                await workers
+                await done.put(None)
+                await writer
+            finally:
+                # on any error do not leave tasks waiting on bounded queues
+                for task in [ workers, *tasks ]:
+                    task.cancel()
+                await asyncio.gather(workers, *tasks, return_exceptions=True)
+
+    def crawl(self, public_ids, update: bool = False):
+        """ load users from network to LMDB (private profiles are skipped)
+
+            update: users are already stored, load only new reviews (see user.FeedPager)
+        """
+        public_ids = [ public_id for public_id in dict.fromkeys(public_ids) if not db.is_private_profile(public_id) ]
+        self.update = update
+        self.loaded = self.private = self.failed = 0
+        if not public_ids:
+            return
+
+        started = time.time()
+        asyncio.run(self.crawl_async(public_ids))
+        logger.info(f"{'Updated' if update else 'Crawled'} {len(public_ids)} users in {time.time() - started:.1f}s: "
+                    f"loaded {self.loaded} private {self.private} failed {self.failed}")
+
+
+def crawl_users(public_ids, update: bool = False):
+    UserCrawler().crawl(public_ids, update=update)
@@ -1,8 +1,11 @@
 from rich import print_json
 from pathlib import Path
 import json
+import time
+import threading
 from loguru import logger
 
+from .lmdbenv import read_txn, write_txn, prefix_iter
 
 
 """
@@ -12,8 +15,19 @@ from loguru import logger
         70000001026994387
         70000001052074829
         70000001037658506
-        141373143684631    
+        141373143684631
+
+    stored in LMDB as private:<public_id> and nocompany:<oid> keys (value is time when added),
+    so membership check is one lookup and adding is one small write, safe from many worker processes.
+    Old JSON lists (private_profiles.json, nocompanies.json) are imported once and renamed to *.migrated.
+    Many worker processes/threads may start migration at same time: file is read inside LMDB write
+    transaction (one writer at a time), import is idempotent, and missing file means already migrated.
 """
+
+PRIVATE_PREFIX = b'private:'
+NOCOMPANY_PREFIX = b'nocompany:'
+
+
 class MyDB:
     def __init__(self, directory=Path("~/.cache").expanduser()):
         self.directory = directory
@@ -25,63 +39,84 @@ class MyDB:
         self.path_private_profiles = self.directory / "private_profiles.json"
         self.path_nocompanies = self.directory / "nocompanies.json"
 
-        self.private_profiles = list()
-        self.nocompanies = list()
-
-        self.load()
-
-
-    def load_private_profiles(self):
-        if self.path_private_profiles.exists():
-            with open(self.path_private_profiles) as f:
-                self.private_profiles = json.load(f)
-                #print(f"ZZZ DB Loaded {len(self.private_profiles)} private profiles")
-                #print(f"mtime: {int(self.path_private_profiles.stat().st_mtime)}")
-                #print(f"sz: {self.path_private_profiles.stat().st_size}")
+        # LMDB is not opened on import, legacy files are migrated on first use
+        self._migrated = False
+        self._migrate_lock = threading.Lock()
 
-    def load_nocompanies(self):
-        if self.path_nocompanies.exists():
-            with open(self.path_nocompanies) as f:
-                self.nocompanies = json.load(f)
-
-    def load(self):
-        self.load_nocompanies()
-        self.load_private_profiles()
+    def _migrate_file(self, path: Path, prefix: bytes):
+        if not path.exists():
+            return
 
-    def save_private_profiles(self):
-        with open(self.path_private_profiles, 'w') as f:
-            json.dump(self.private_profiles, f)
-            # logger.info(f"Saved {len(self.private_profiles)} private profiles")
+        value = json.dumps(int(time.time())).encode()
+        with write_txn() as txn:
+            try:
+                with open(path) as f:
+                    items = json.load(f)
+            except FileNotFoundError:
+                # migrated by other process
+                return
+            for item in items:
+                txn.put(prefix + item.encode(), value, overwrite=False)
+
+        try:
+            path.rename(path.with_suffix('.json.migrated'))
+        except FileNotFoundError:
+            # other process imported same file after our commit and renamed it
+            return
+        logger.info(f"Migrated {len(items)} records from {path} to LMDB")
 
-    def save_nocompanies(self):
-        with open(self.path_nocompanies, 'w') as f:
-            json.dump(self.nocompanies, f)
+    def migrate(self):
+        if self._migrated:
+            return
+        with self._migrate_lock:
+            if self._migrated:
+                return
+            self._migrate_file(self.path_private_profiles, PRIVATE_PREFIX)
+            self._migrate_file(self.path_nocompanies, NOCOMPANY_PREFIX)
+            self._migrated = True
+
+    def _exists(self, key: bytes) -> bool:
+        self.migrate()
+        with read_txn() as txn:
+            return txn.get(key) is not None
+
+    def _add(self, key: bytes):
+        self.migrate()
+        with write_txn() as txn:
+            txn.put(key, json.dumps(int(time.time())).encode(), overwrite=False)
+
+    def _delete(self, key: bytes):
+        self.migrate()
+        with write_txn() as txn:
+            txn.delete(key)
+
+    def _count(self, prefix: bytes) -> int:
+        self.migrate()
+        return sum(1 for _ in prefix_iter(prefix))
 
     def is_private_profile(self, public_id):
-        return public_id in self.private_profiles
+        return self._exists(PRIVATE_PREFIX + public_id.encode())
 
     def is_nocompany(self, company_id):
-        return company_id in self.nocompanies
+        return self._exists(NOCOMPANY_PREFIX + company_id.encode())
 
     def add_private_profile(self, public_id):
-        self.private_profiles.append(public_id)
-        self.save_private_profiles()
-
+        self._add(PRIVATE_PREFIX + public_id.encode())
 
     def add_nocompany(self, company_id):
-        if company_id in self.nocompanies:
-            return
-        self.nocompanies.append(company_id)
-        self.save_nocompanies()
+        self._add(NOCOMPANY_PREFIX + company_id.encode())
 
     def remove_nocompany(self, company_id):
-        if company_id in self.nocompanies:
-            self.nocompanies.remove(company_id)
-            self.save_nocompanies()
+        self._delete(NOCOMPANY_PREFIX + company_id.encode())
+
+    def nocompanies(self):
+        self.migrate()
+        for key, _ in prefix_iter(NOCOMPANY_PREFIX):
+            yield bytes(key[len(NOCOMPANY_PREFIX):]).decode()
 
     def dump(self):
-        print("private profiles:", len(self.private_profiles))
-        print("companies todo:", len(self.nocompanies))
-        print_json(data=list(self.nocompanies))
+        print("private profiles:", self._count(PRIVATE_PREFIX))
+        print("companies todo:", self._count(NOCOMPANY_PREFIX))
+        print_json(data=list(self.nocompanies()))
 
-db = MyDB()
\ No newline at end of file
+db = MyDB()
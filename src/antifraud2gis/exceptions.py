@@ -20,4 +20,8 @@ class AFCompanyError(AFException):
 
 class AFCompanyNotFound(AFException):
     # company not found in LMDB 
-    pass
\ No newline at end of file
+    pass
+
+class AFNetworkError(AFException):
+    # cannot load data from 2GIS API after retries
+    pass
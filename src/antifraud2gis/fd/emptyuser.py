@@ -2,7 +2,7 @@ from collections import Counter
 import numpy as np
 
 from .fd import BaseFD
-from ..user import User
+from ..user import User, get_user
 from ..company import Company
 from ..review import Review
 from ..settings import settings
@@ -33,16 +33,36 @@ class EmptyUserFD(BaseFD):
                 if cr.uid is None:
                     self.records.append(f"NONE {cr.created_str} {cr.rating } {cr.provider} uid:{cr.uid} {cr.user_name} ")
                 else:
-                    u = User(cr.uid)
+                    u = get_user(cr.uid)
                     u.load()
                     self.records.append(f"EMPTY {cr.created_str} {cr.rating} {cr.provider} uid: {cr.uid} {u.name} nr:{u.nreviews()}")
 
         else:
             self.non_empty_ratings.append(cr.rating)
-            u = User(cr.uid)
+            u = get_user(cr.uid)
             u.load()
             self.records.append(f"REAL {cr.created_str} {cr.rating} uid: {cr.uid} {u.name} nr:{u.nreviews()}")
         
+    def score_batch(self, table):
+        self.empty_ratings = table.rating[table.is_empty].tolist()
+        self.non_empty_ratings = table.rating[~table.is_empty].tolist()
+
+        for idx in range(len(table)):
+            created_str = table.created_str(idx)
+            rating = table.rating[idx]
+            uid = table.uid[idx]
+            u = table.users[idx]
+
+            if not table.is_empty[idx]:
+                self.records.append(f"REAL {created_str} {rating} uid: {uid} {u.name} nr:{u.nreviews()}")
+            elif self._explain:
+                if uid is None:
+                    self.records.append(f"NONE {created_str} {rating } {table.provider[idx]} uid:{uid} {table.user_name[idx]} ")
+                else:
+                    self.records.append(f"EMPTY {created_str} {rating} {table.provider[idx]} uid: {uid} {u.name} nr:{u.nreviews()}")
+
+        return self.get_score()
+
     def get_score(self):
 
         if len(self.empty_ratings) < settings.apply_empty_user_min:
@@ -19,6 +19,14 @@ class BaseFD():
     def feed(self, rev: Review, empty=False):
         pass
 
+    def feed_many(self, reviews, empty=False):
+        for rev in reviews:
+            self.feed(rev, empty=empty)
+
+    def score_batch(self, table: 'ReviewTable'):
+        """ batch mode: take all reviews from columnar table at once instead of feed() """
+        return self.get_score()
+
     def get_score(self):
         pass
 
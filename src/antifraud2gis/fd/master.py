@@ -48,8 +48,8 @@ class MasterFD(BaseFD):
         self.providers = defaultdict(int)
 
 
-    def feed(self, cr: Review):
-        # only A-company review feeded here
+    def feed(self, cr: Review, empty=False):
+        # only A-company review feeded here, empty is detected here (argument is for BaseFD.feed_many)
         self.score['total_reviews'] += 1
 
         empty = False
@@ -80,10 +80,23 @@ class MasterFD(BaseFD):
         for detector in self.triggered:
             detector.explain(fh = fh)
 
+    def score_batch(self, table):
+        """ batch mode: whole company at once, same result as feed() for each review and get_score() """
+        self.score['total_reviews'] = len(table)
+        self.score['empty_reviews'] = int(table.is_empty.sum())
+        self.score['processed_reviews'] = len(table) - self.score['empty_reviews']
+        self.providers = Counter(table.provider.tolist())
+        self._users = set(uid for uid in table.uid.tolist() if uid is not None)
+
+        return self._join_scores({ name: d.score_batch(table) for name, d in self._detectors.items() })
+
     def get_score(self):
+        return self._join_scores({ name: d.get_score() for name, d in self._detectors.items() })
+
+    def _join_scores(self, scores: dict):
 
         for detector_name, detector in self._detectors.items():
-            detector_score = detector.get_score()
+            detector_score = scores[detector_name]
             # carefully join
 
             for k in detector_score.keys():
@@ -23,6 +23,9 @@ class MedianAgeFD(BaseFD):
         self.user_ages = list()
         self.records = list()
         self.low_rating = 0
+        # collected as lists, converted to array once in get_score
+        self.ages = list()
+        self.ratings = list()
         self.agerate = np.empty((0, 2), dtype=int)
         self.processed = 0
 
@@ -33,15 +36,30 @@ class MedianAgeFD(BaseFD):
 
         u = cr.user
 
-        self.agerate = np.vstack([self.agerate, [cr.user_age, cr.rating]])
+        self.ages.append(cr.user_age)
+        self.ratings.append(cr.rating)
         self.records.append(f"{u.public_id} {cr.rating} ({u.name} {cr.created_str} - {u.birthday_str}) = {cr.user_age}")
         self.processed += 1
 
+    def score_batch(self, table):
+        mask = ~table.is_empty
+        self.ages = table.user_age[mask].tolist()
+        self.ratings = table.rating[mask].tolist()
+        self.processed = len(self.ages)
+
+        for idx in np.flatnonzero(mask):
+            u = table.users[idx]
+            self.records.append(f"{u.public_id} {table.rating[idx]} ({u.name} {table.created_str(idx)} - {u.birthday_str}) = {table.user_age[idx]}")
+
+        return self.get_score()
+
     def get_score(self):
 
         if self.processed <= settings.apply_median_userage:
             return self.score
 
+        self.agerate = np.array([self.ages, self.ratings], dtype=int).T.reshape(-1, 2)
+
         if len(self.agerate) == 0:
             return self.score
         
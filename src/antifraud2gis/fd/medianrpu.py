@@ -32,18 +32,37 @@ class MedianRPUFD(BaseFD):
             return
 
         u = cr.user
-        # self.rpu.append(u.nreviews())
-        self.rpu_list.append(u.nreviews())
-        if u.nreviews() <= settings.median_rpu:
+        nreviews = u.nreviews()
+        # self.rpu.append(nreviews)
+        self.rpu_list.append(nreviews)
+        if nreviews <= settings.median_rpu:
             self.lrpu_ratings.append(cr.rating)
         else:
             self.hrpu_ratings.append(cr.rating)
 
-        if self.explain and u.nreviews() <= settings.median_rpu:
-            self.records.append(f"{u.public_id} {u.name} rating: {cr.rating} num_reviews: {u.nreviews()}")
+        if self.explain and nreviews <= settings.median_rpu:
+            self.records.append(f"{u.public_id} {u.name} rating: {cr.rating} num_reviews: {nreviews}")
 
         self.processed += 1
 
+    def score_batch(self, table):
+        mask = ~table.is_empty
+        rpu = table.user_nreviews[mask]
+        ratings = table.rating[mask]
+        low = rpu <= settings.median_rpu
+
+        self.rpu_list = rpu.tolist()
+        self.lrpu_ratings = ratings[low].tolist()
+        self.hrpu_ratings = ratings[~low].tolist()
+        self.processed = int(mask.sum())
+
+        if self.explain:
+            for idx in np.flatnonzero(mask & (table.user_nreviews <= settings.median_rpu)):
+                u = table.users[idx]
+                self.records.append(f"{u.public_id} {u.name} rating: {table.rating[idx]} num_reviews: {table.user_nreviews[idx]}")
+
+        return self.get_score()
+
     def get_score(self):
 
         if self.processed <= settings.apply_median_rpu:
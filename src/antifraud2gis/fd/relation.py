@@ -10,6 +10,8 @@ from ..companydb import get_by_oid
 from ..review import Review
 from ..settings import settings
 from ..relation import RelationDict
+from ..reviewmatrix import ReviewMatrix
+from ..userrecord import decode_rating
 
 
 
@@ -44,19 +46,34 @@ class RelationFD(BaseFD):
 
 
         u: User = cr.user
-        for r in u.reviews():
-
-            if r.oid == self._c.object_id:
+        cols = u.columns()
+        for oid, rating in zip(cols['oid'].tolist(), cols['rating'].tolist()):
+            oid = str(oid)
+            if oid == self._c.object_id:
                 continue
 
-            rel = self._c.relations[r.oid]
-            rel.hit(cr.rating, r)
+            rel = self._c.relations[oid]
+            rel.hit(cr.rating, u, decode_rating(rating))
 
         self.processed_users += 1
 
         #if self.explain:
         #    self.records.append(f"{u.public_id} {u.name} {cr.rating} {u.nreviews()}")
 
+    def score_batch(self, table):
+        # relations of all users at once as sparse row product
+        rows = np.flatnonzero(~table.is_empty)
+        users = [ table.users[idx] for idx in rows.tolist() ]
+        aratings = [ table.rating[idx] for idx in rows.tolist() ]
+
+        matrix = ReviewMatrix(users)
+        co = matrix.co_reviews({ self._c.object_id: (np.arange(len(users)), aratings) })
+        self._c.relations.load_co_reviews(co[self._c.object_id], users)
+
+        self.processed_users = len(users)
+
+        return self.get_score()
+
     def get_score(self):
         self._c.relations.calc()
 
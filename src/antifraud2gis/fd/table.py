@@ -0,0 +1,66 @@
+import datetime
+import numpy as np
+
+from ..company import Company
+from ..user import User, get_user, load_users
+from ..settings import settings
+from ..utils import today, EPOCH_ORDINAL
+
+"""
+    Columnar table of company reviews for batch detection (see MasterFD.score_batch)
+    Built once per detection, one row per (not expired) company review, same order as Company.reviews()
+"""
+
+class ReviewTable:
+
+    uid: np.ndarray
+    user_name: np.ndarray
+    rating: np.ndarray
+    created: np.ndarray
+    user_age: np.ndarray
+    user_nreviews: np.ndarray
+    is_empty: np.ndarray
+    provider: np.ndarray
+
+    def __init__(self, c: Company):
+        min_day = today() - settings.max_review_age
+        rows = [ r for r in c._reviews if r['created_day'] >= min_day ]
+
+        uids = [ r['user']['public_id'] for r in rows ]
+        load_users(uids)
+
+        self.users = [ get_user(uid) if uid is not None else None for uid in uids ]
+
+        n = len(rows)
+        self.uid = np.array(uids, dtype=object)
+        self.user_name = np.array([ r['user']['name'] for r in rows ], dtype=object)
+        # int array, or object array if some ratings are None
+        self.rating = np.array([ r['rating'] for r in rows ])
+        self.created = np.array([ r['created_day'] for r in rows ], dtype=int)
+        self.provider = np.array([ r.get('provider') for r in rows ], dtype=object)
+
+        self.user_nreviews = np.zeros(n, dtype=int)
+        # -1 for users without public reviews
+        birthday = np.full(n, -1, dtype=int)
+        # duplicate reviews from same user are counted as empty, like in MasterFD.feed
+        duplicate = np.zeros(n, dtype=bool)
+
+        seen = set()
+        for idx, (uid, u) in enumerate(zip(uids, self.users)):
+            if u is None:
+                continue
+            self.user_nreviews[idx] = u.nreviews()
+            bday = u.birthday_day()
+            if bday is not None:
+                birthday[idx] = bday
+            duplicate[idx] = uid in seen
+            seen.add(uid)
+
+        self.is_empty = (self.uid == None) | (self.user_nreviews <= 1) | duplicate
+        self.user_age = np.where(birthday >= 0, self.created - birthday, -1)
+
+    def created_str(self, idx: int) -> str:
+        return datetime.date.fromordinal(EPOCH_ORDINAL + int(self.created[idx])).isoformat()
+
+    def __len__(self):
+        return len(self.uid)
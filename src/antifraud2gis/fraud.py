@@ -17,14 +17,24 @@ from .const import WSCORE_THRESHOLD, WSCORE_HITS_THRESHOLD, MAX_USER_REVIEWS
 from .logger import logger
 from .company import Company, CompanyList
 from .companydb import update_company, get_by_oid, check_by_oid
+from .companyinfo import CompanyInfo
 from .user import User, get_user
 from .relation import RelationDict
 from .settings import settings
 from .exceptions import AFReportNotReady, AFNoCompany, AFReportAlreadyExists
 # from .usernotes import Usernotes
 from .fd.master import MasterFD
+from .fd.table import ReviewTable
+from .lmdbenv import read_session
+from .utils import reset_today
 
 def detect(c: Company, cl: CompanyList, explain: bool = False, force=False):
+    # review ages are counted from same day for whole detection
+    reset_today()
+    return _detect(c, cl, explain=explain, force=force)
+
+
+def _detect(c: Company, cl: CompanyList, explain: bool = False, force=False):
 
     debug_oids = os.getenv("DEBUG_OIDS", "").split(" ")
     debug_uids = os.getenv("DEBUG_UIDS", "").split(" ")
@@ -80,22 +90,28 @@ def detect(c: Company, cl: CompanyList, explain: bool = False, force=False):
 
     master_detector = MasterFD(c, explain=True)
 
-    with Progress() as progress:
-        task = progress.add_task("[cyan]Analyzing user's reviews...", total=c.nreviews())
+    # scoring reads only local data (users are loaded above): all LMDB reads share one read transaction,
+    # it is not kept open during network loads (other workers' writes stay visible, old pages can be reused)
+    with read_session():
+        if settings.batch_detect:
+            score = master_detector.score_batch(ReviewTable(c))
+        else:
+            with Progress() as progress:
+                task = progress.add_task("[cyan]Analyzing user's reviews...", total=c.nreviews())
 
-        for idx, cr in enumerate(c.reviews(), start=1):
-            # notes.counter('total_reviews')
-            progress.update(task, advance=1, description=f"[green]User {idx}")
+                for idx, cr in enumerate(c.reviews(), start=1):
+                    # notes.counter('total_reviews')
+                    progress.update(task, advance=1, description=f"[green]User {idx}")
 
-            master_detector.feed(cr)    
+                    master_detector.feed(cr)    
 
-    score = master_detector.get_score()
+            score = master_detector.get_score()
 
-    # logger.info(f"SCORE: {score} for {c.object_id}")
+        # logger.info(f"SCORE: {score} for {c.object_id}")
 
-    report = dict()
-    report['score'] = score
-    report['relations'] = c.relations.export()
+        report = dict()
+        report['score'] = score
+        report['relations'] = c.relations.export()
 
     with gzip.open(c.report_path, "wt") as fh:
         json.dump(report, fh)
@@ -147,8 +163,10 @@ def dump_report(object_id: str):
     table.add_column("Median")
     table.add_column("Rating")
 
+    companies = CompanyInfo.lookup_many(rel['oid'] for rel in report['relations'])
+
     for rel in report['relations']:
-        _c = Company(rel['oid'])
+        _c = companies.get(rel['oid']) or CompanyInfo(rel['oid'])
 
         if rel['risk']:
             tags_cell = Text(f"{rel['tags'] or ''}*")
@@ -0,0 +1,181 @@
+import json
+import time
+import itertools
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from requests.exceptions import RequestException
+
+from .settings import settings
+from .lmdbenv import write_txn, prefix_iter
+from .company import Company
+from .user import load_users, reset_user_pool
+from .crawler import crawl_users
+from .db import db
+from .exceptions import AFNoCompany, AFNoTitle, AFCompanyError, AFNetworkError
+from .logger import logger
+
+"""
+    Breadth-first crawler over company <-> user graph (af2dev crawl).
+
+    Company node: basic info and reviews are loaded (cached in company_storage), its users are queued.
+    User node: reviews are loaded to LMDB (missing users are fetched by async crawler), companies
+    from user reviews (optionally only in one town) are queued.
+    Everything loaded is later used by detect() from local cache.
+
+    Frontier is kept in LMDB:
+        crawl:q:<depth>:<seq>   -> {"kind": "company"|"user", "id": ..., "depth": N, "tries": N}
+                                   ordered by depth (BFS), then by time queued
+        crawl:seen:<kind>:<id>  -> depth, each node is queued only once
+        crawl:seq               -> last seq
+
+    Batch is removed from queue in the same write transaction where its neighbours are queued,
+    so crawl can be stopped any time and resumed (unfinished batch is processed again).
+    GraphCrawler.reset() (af2dev crawl --reset) forgets frontier and seen nodes.
+"""
+
+QUEUE_PREFIX = b'crawl:q:'
+SEEN_PREFIX = b'crawl:seen:'
+SEQ_KEY = b'crawl:seq'
+
+COMPANY = 'company'
+USER = 'user'
+
+
+class GraphCrawler:
+
+    def __init__(self, town: str = None, maxdepth: int = None, batch: int = None):
+        self.town = town.lower() if town else None
+        self.maxdepth = maxdepth
+        self.batch = batch or settings.crawl_batch
+
+        # counters for last run
+        self.processed = 0
+        self.queued = 0
+        self.failed = 0
+
+    def _push(self, txn, kind: str, node_id: str, depth: int, tries: int = 0, requeue: bool = False) -> bool:
+        """ queue node if not seen before (or again if requeue) """
+        seen_key = SEEN_PREFIX + f'{kind}:{node_id}'.encode()
+        if not txn.put(seen_key, str(depth).encode(), overwrite=requeue) and not requeue:
+            return False
+
+        seq = int(txn.get(SEQ_KEY) or 0) + 1
+        txn.put(SEQ_KEY, str(seq).encode())
+        item = { 'kind': kind, 'id': node_id, 'depth': depth, 'tries': tries }
+        txn.put(QUEUE_PREFIX + f'{depth:04d}:{seq:012d}'.encode(), json.dumps(item).encode())
+        return True
+
+    def seed(self, kind: str, node_ids) -> int:
+        """ add start nodes (depth 0), returns number of new nodes """
+        with write_txn() as txn:
+            return sum(self._push(txn, kind, node_id, 0) for node_id in node_ids)
+
+    def next_batch(self) -> list:
+        """ first nodes in queue as list of (key, item) """
+        return [ (bytes(key), json.loads(val)) for key, val in itertools.islice(prefix_iter(QUEUE_PREFIX), self.batch) ]
+
+    @staticmethod
+    def reset():
+        with write_txn() as txn:
+            keys = [ bytes(key) for key, _ in prefix_iter(b'crawl:', txn=txn) ]
+            for key in keys:
+                txn.delete(key)
+
+    @staticmethod
+    def qsize() -> int:
+        return sum(1 for _ in prefix_iter(QUEUE_PREFIX))
+
+    @staticmethod
+    def nseen() -> int:
+        return sum(1 for _ in prefix_iter(SEEN_PREFIX))
+
+    def expand_companies(self, oids: list) -> dict:
+        """ oid -> list of user ids, or None if should be retried later (network error) """
+
+        def expand(oid):
+            if db.is_nocompany(oid):
+                return list()
+            try:
+                c = Company(oid)
+                c.load_reviews()
+            except (AFNoCompany, AFNoTitle, AFCompanyError):
+                db.add_nocompany(oid)
+                return list()
+            except (AFNetworkError, RequestException) as e:
+                logger.warning(f"crawl: cannot load company {oid}: {e}")
+                return None
+            return list(dict.fromkeys(c.uids()))
+
+        with ThreadPoolExecutor(max_workers=max(1, settings.company_prefetch)) as pool:
+            return dict(zip(oids, pool.map(expand, oids)))
+
+    def expand_users(self, uids: list) -> dict:
+        """ uid -> list of company ids (in self.town, if set), or None if should be retried later """
+        users = load_users(uids)
+        missing = set(uids) - users.keys()
+        if missing:
+            crawl_users(missing)
+            users.update(load_users(missing))
+
+        result = dict()
+        for uid in uids:
+            if uid in users:
+                result[uid] = list(dict.fromkeys(
+                    r.oid for r in users[uid].reviews()
+                    if self.town is None or (r.get_town() or '').lower() == self.town))
+            elif db.is_private_profile(uid):
+                result[uid] = list()
+            else:
+                result[uid] = None
+        return result
+
+    def run(self, limit: int = None, stopfile: Path = None):
+        """ process queue until it is empty (or limit nodes processed, or stopfile appears) """
+        self.processed = self.queued = self.failed = 0
+        started = time.time()
+
+        while True:
+            batch = self.next_batch()
+            if limit is not None:
+                batch = batch[:limit - self.processed]
+            if not batch:
+                break
+
+            expanded = dict()
+            for kind, expand in ((COMPANY, self.expand_companies), (USER, self.expand_users)):
+                ids = [ item['id'] for _, item in batch if item['kind'] == kind ]
+                if ids:
+                    expanded.update({ (kind, node_id): nbrs for node_id, nbrs in expand(ids).items() })
+
+            with write_txn() as txn:
+                for key, item in batch:
+                    txn.delete(key)
+                    neighbours = expanded[(item['kind'], item['id'])]
+                    if neighbours is None:
+                        # retry later (at the end of same depth), give up after network_retries
+                        if item['tries'] + 1 < settings.network_retries:
+                            self._push(txn, item['kind'], item['id'], item['depth'], tries=item['tries'] + 1, requeue=True)
+                        else:
+                            self.failed += 1
+                        continue
+
+                    self.processed += 1
+                    if self.maxdepth is not None and item['depth'] >= self.maxdepth:
+                        continue
+                    nkind = USER if item['kind'] == COMPANY else COMPANY
+                    for node_id in neighbours:
+                        self.queued += self._push(txn, nkind, node_id, item['depth'] + 1)
+
+            # user pool is cache for one detection, do not let it grow
+            reset_user_pool()
+
+            logger.info(f"crawl: processed {self.processed} nodes (depth {batch[-1][1]['depth']}), "
+                        f"queued {self.queued} new, failed {self.failed}, {time.time() - started:.0f}s")
+
+            if limit is not None and self.processed >= limit:
+                break
+            if stopfile is not None and stopfile.exists():
+                logger.info("Stopfile found, exit")
+                stopfile.unlink()
+                break
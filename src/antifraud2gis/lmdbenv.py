@@ -0,0 +1,136 @@
+import os
+import threading
+from contextlib import contextmanager
+
+import lmdb
+
+from .settings import settings
+from .const import LMDB_MAP_SIZE
+
+"""
+    Shared LMDB environment.
+
+    LMDB must be opened only once per process, and environment inherited from parent process
+    must not be used after fork() (dramatiq forks worker processes), so we keep one env per pid.
+    Writers are serialized: by _write_lock between threads, by LMDB itself between processes.
+
+    All LMDB access goes via read_txn() / write_txn().
+    Inside read_session() (scoring phase of detection) all read_txn() calls in this thread reuse the same
+    read transaction. It is re-created after any write commit, so data saved by this process is visible.
+    Keep sessions short and without network I/O: writes of other processes are not visible inside session,
+    and open read transaction does not let LMDB reuse pages freed after it started.
+"""
+
+_env = None
+_env_pid = None
+_env_lock = threading.Lock()
+
+# serialize writers inside process (LMDB itself serializes between processes)
+_write_lock = threading.RLock()
+
+# incremented after each committed write, session transactions older than this are re-created
+_write_gen = 0
+
+_local = threading.local()
+
+
+def get_env() -> lmdb.Environment:
+    global _env, _env_pid
+
+    pid = os.getpid()
+    if _env is not None and _env_pid == pid:
+        return _env
+
+    with _env_lock:
+        if _env is None or _env_pid != pid:
+            # env from parent process (if any) is just dropped, not closed: it's not ours
+            _env = lmdb.open(settings.lmdb_storage.as_posix(), map_size=LMDB_MAP_SIZE, max_readers=settings.lmdb_max_readers)
+            _env_pid = pid
+    return _env
+
+
+def _session_txn():
+    """ return read transaction of current read_session() or None """
+    if getattr(_local, 'depth', 0) == 0 or _local.pid != os.getpid():
+        return None
+
+    if _local.txn is None or _local.gen != _write_gen:
+        # old transaction is not aborted here: cursor may still iterate it, it is released when unreferenced
+        _local.gen = _write_gen
+        _local.txn = get_env().begin()
+
+    return _local.txn
+
+
+@contextmanager
+def read_session():
+    """ reuse one read transaction for all reads inside this block (in this thread) """
+    if getattr(_local, 'pid', None) != os.getpid():
+        # fresh thread or forked child
+        _local.depth = 0
+        _local.txn = None
+        _local.gen = None
+        _local.pid = os.getpid()
+
+    _local.depth += 1
+    try:
+        yield
+    finally:
+        _local.depth -= 1
+        if _local.depth == 0:
+            # aborted when unreferenced
+            _local.txn = None
+
+
+@contextmanager
+def read_txn():
+    txn = _session_txn()
+    if txn is not None:
+        yield txn
+        return
+
+    with get_env().begin() as txn:
+        yield txn
+
+
+@contextmanager
+def write_txn():
+    global _write_gen
+
+    with _write_lock:
+        with get_env().begin(write=True) as txn:
+            yield txn
+        _write_gen += 1
+
+
+def lmdb_get(key: bytes):
+    with read_txn() as txn:
+        return txn.get(key)
+
+
+def lmdb_getmulti(keys) -> dict:
+    """ get many keys in one transaction, returns dict key -> value (only found keys) """
+    # sorted keys make cursor walk the B-tree forward instead of random point lookups
+    keys = sorted(set(keys))
+    if not keys:
+        return dict()
+
+    with read_txn() as txn:
+        with txn.cursor() as cur:
+            return dict(cur.getmulti(keys))
+
+
+def prefix_iter(prefix: bytes, txn=None, start: bytes = None):
+    """ iterate (key, value) for all keys with prefix (optionally from key start) """
+    if txn is None:
+        with read_txn() as txn:
+            yield from prefix_iter(prefix, txn=txn, start=start)
+        return
+
+    with txn.cursor() as cur:
+        if not cur.set_range(start or prefix):
+            return
+        for key, val in cur:
+            if not key.startswith(prefix):
+                return
+            yield key, val
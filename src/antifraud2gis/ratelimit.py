@@ -0,0 +1,333 @@
+import time
+import math
+import random
+import threading
+import email.utils
+
+import redis
+from redis.retry import Retry
+from redis.backoff import NoBackoff
+
+from .settings import settings
+from .const import REDIS_RATELIMIT_PREFIX, REDIS_CIRCUIT_PREFIX
+from .logger import logger
+
+"""
+    Rate limiting for 2GIS API requests.
+
+    Each API (reviews API, public-profile API) is an Endpoint with:
+        - TokenBucket: global limit of requests per second, shared by all worker processes via Redis
+        - CircuitBreaker: after many errors in a row all processes pause requests to this API for a while
+        - AdaptiveLimiter: per-process pacing, delay grows on 429/5xx (or Retry-After) and shrinks after success
+
+    If Redis is not available, bucket and breaker work locally (per process).
+"""
+
+# do not try Redis again for this time after error
+REDIS_RETRY_PERIOD = 30
+
+# fail fast, no reconnect retries: limits fall back to local if Redis is down
+_redis = redis.Redis(decode_responses=True, socket_timeout=2, socket_connect_timeout=2, retry=Retry(NoBackoff(), 0))
+_redis_failed = 0
+
+
+def get_redis():
+    """ Redis connection or None if Redis failed recently """
+    if time.time() - _redis_failed < REDIS_RETRY_PERIOD:
+        return None
+    return _redis
+
+
+def redis_failed(e: Exception):
+    global _redis_failed
+    if time.time() - _redis_failed >= REDIS_RETRY_PERIOD:
+        logger.warning(f"Redis unavailable for rate limiting ({e}), using local limits")
+    _redis_failed = time.time()
+
+
+def backoff_delay(attempt: int, base: float = 1, cap: float = 60) -> float:
+    """ exponential backoff with jitter for retry number attempt (0-based) """
+    return random.uniform(0.5, 1) * min(cap, base * 2 ** attempt)
+
+
+def retry_after(response) -> float:
+    """ seconds from Retry-After header (seconds or HTTP date), None if missing """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_throttled(response) -> bool:
+    """ should request be retried later (API overloaded or rate limited us) """
+    return response.status_code == 429 or response.status_code >= 500
+
+
+class AdaptiveLimiter:
+    """ thread-safe pacing of requests to one API """
+
+    def __init__(self, name: str, min_delay: float = 0, max_delay: float = 60, backoff: float = 2, recover: float = 0.8):
+        self.name = name
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.recover = recover
+
+        self.delay = min_delay
+        self.throttled_count = 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """ sleep until our turn to send request """
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.delay
+        if slot > now:
+            time.sleep(slot - now)
+
+    def ok(self):
+        """ successful request, speed up """
+        with self._lock:
+            self.delay = max(self.min_delay, self.delay * self.recover)
+            if self.delay < 0.01:
+                self.delay = self.min_delay
+
+    def throttled(self, pause: float = None):
+        """ 429/5xx/network error, slow down (and pause all requests for pause seconds, e.g. from Retry-After) """
+        with self._lock:
+            self.throttled_count += 1
+            self.delay = min(self.max_delay, max(self.delay * self.backoff, 0.5, pause or 0))
+            self._next = max(self._next, time.monotonic() + (pause if pause is not None else self.delay))
+        logger.debug(f"{self}: throttled")
+
+    def __repr__(self):
+        return f"AdaptiveLimiter({self.name} delay: {self.delay:.2f}s throttled: {self.throttled_count})"
+
+
+# returns seconds to wait (as string), 0 if token taken
+TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(wait)
+"""
+
+
+class TokenBucket:
+    """ at most rate requests per second (with bursts up to burst), for all processes """
+
+    def __init__(self, name: str, rate: float, burst: float = 1):
+        self.name = name
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.key = REDIS_RATELIMIT_PREFIX + name
+        self._script = None
+
+        # local bucket (Redis not available)
+        self._tokens = self.burst
+        self._ts = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take_local(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._ts) * self.rate)
+            self._ts = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def _take(self) -> float:
+        """ take token, or return how long to wait for it """
+        r = get_redis()
+        if r is not None:
+            try:
+                if self._script is None:
+                    self._script = r.register_script(TOKEN_BUCKET_LUA)
+                return float(self._script(keys=[self.key], args=[self.rate, self.burst]))
+            except redis.RedisError as e:
+                redis_failed(e)
+        return self._take_local()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            wait = self._take()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """ stop requests to API for cooldown seconds after threshold errors in a row
+
+        closed: requests allowed
+        open: requests wait until cooldown is over
+        half-open: cooldown is over, one probe request is allowed (probe key, SET NX), others wait.
+            probe success closes circuit, error opens it again. Probe key expires after cooldown
+            in case probe result is never reported.
+    """
+
+    def __init__(self, name: str, threshold: int, cooldown: float):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.key = REDIS_CIRCUIT_PREFIX + name
+        self.probe_key = self.key + ':probe'
+
+        # local state (Redis not available)
+        self._local = { 'failures': 0, 'opened': 0 }
+        # local probe expiration time (monotonic)
+        self._local_probe = 0
+        self._lock = threading.Lock()
+
+    def _get(self) -> dict:
+        r = get_redis()
+        if r is not None:
+            try:
+                data = r.hgetall(self.key)
+                return { 'failures': int(data.get('failures', 0)), 'opened': float(data.get('opened', 0)) }
+            except redis.RedisError as e:
+                redis_failed(e)
+        return dict(self._local)
+
+    def state(self) -> dict:
+        data = self._get()
+        if data['failures'] < self.threshold:
+            data['state'] = 'closed'
+        elif time.time() - data['opened'] < self.cooldown:
+            data['state'] = 'open'
+            data['retry_in'] = math.ceil(self.cooldown - (time.time() - data['opened']))
+        else:
+            data['state'] = 'half-open'
+        return data
+
+    def _take_probe(self) -> bool:
+        """ True if we may send the only request in half-open state """
+        r = get_redis()
+        if r is not None:
+            try:
+                return bool(r.set(self.probe_key, 1, nx=True, ex=max(1, math.ceil(self.cooldown))))
+            except redis.RedisError as e:
+                redis_failed(e)
+        with self._lock:
+            now = time.monotonic()
+            if now < self._local_probe:
+                return False
+            self._local_probe = now + self.cooldown
+            return True
+
+    def _release_probe(self, r):
+        if r is not None:
+            r.delete(self.probe_key)
+        else:
+            self._local_probe = 0
+
+    def wait(self):
+        """ block while circuit is open (or half-open and other request is probing) """
+        while True:
+            data = self.state()
+            if data['state'] == 'closed':
+                return
+            if data['state'] == 'half-open':
+                if self._take_probe():
+                    logger.info(f"Circuit {self.name} is half-open, probe request")
+                    return
+                time.sleep(1)
+                continue
+            logger.warning(f"Circuit {self.name} is open, pause requests for {data['retry_in']}s")
+            time.sleep(max(1, data['retry_in']))
+
+    def success(self):
+        r = get_redis()
+        if r is not None:
+            try:
+                r.hset(self.key, mapping={ 'failures': 0, 'opened': 0 })
+                self._release_probe(r)
+                return
+            except redis.RedisError as e:
+                redis_failed(e)
+        with self._lock:
+            self._local = { 'failures': 0, 'opened': 0 }
+            self._release_probe(None)
+
+    def failure(self):
+        r = get_redis()
+        if r is not None:
+            try:
+                failures = r.hincrby(self.key, 'failures', 1)
+                if failures >= self.threshold and self.state()['state'] != 'open':
+                    # open (again, if half-open probe failed)
+                    r.hset(self.key, 'opened', time.time())
+                    self._release_probe(r)
+                    logger.warning(f"Circuit {self.name} opened after {failures} errors")
+                return
+            except redis.RedisError as e:
+                redis_failed(e)
+        with self._lock:
+            self._local['failures'] += 1
+            failures = self._local['failures']
+        if failures >= self.threshold and self.state()['state'] != 'open':
+            self._local['opened'] = time.time()
+            self._release_probe(None)
+            logger.warning(f"Circuit {self.name} opened after {failures} errors")
+
+    def __repr__(self):
+        data = self.state()
+        return f"CircuitBreaker({self.name} {data['state']} failures: {data['failures']})"
+
+
+class Endpoint:
+    """ all limits for one API """
+
+    def __init__(self, name: str, rate: float):
+        self.name = name
+        self.bucket = TokenBucket(name, rate=rate, burst=settings.rate_burst)
+        self.breaker = CircuitBreaker(name, threshold=settings.circuit_threshold, cooldown=settings.circuit_cooldown)
+        self.limiter = AdaptiveLimiter(name)
+
+    def before(self):
+        """ call before each request """
+        self.breaker.wait()
+        self.bucket.acquire()
+        self.limiter.wait()
+
+    def ok(self):
+        self.limiter.ok()
+        self.breaker.success()
+
+    def failed(self, pause: float = None):
+        """ 429/5xx or network error """
+        self.limiter.throttled(pause)
+        self.breaker.failure()
+
+    def __repr__(self):
+        return f"Endpoint({self.name} {self.breaker} {self.limiter})"
+
+
+reviews_api = Endpoint('reviews', rate=settings.reviews_rate)
+profile_api = Endpoint('profile', rate=settings.profile_rate)
@@ -2,10 +2,13 @@ from .company import Company
 from .settings import settings
 from .exceptions import AFNoCompany, AFCompanyError
 from .logger import logger
+from .companyinfo import CompanyInfo
 from .review import Review
+from .reviewmatrix import CoReviews
 import os
+import heapq
 import numpy as np
-from collections import defaultdict
+from collections import defaultdict, Counter
 
 from rich.console import Console
 from rich.table import Table
@@ -21,12 +24,26 @@ from rich import print as rprint, print_json
 users_added = 0
 
 
+def hist_median(hist: Counter, n: int) -> int:
+    """ int(np.median(values)) from histogram value -> number of values """
+    lo_pos = (n - 1) // 2
+    hi_pos = n // 2
+    lo = None
+    seen = 0
+    for value in sorted(hist):
+        seen += hist[value]
+        if lo is None and seen > lo_pos:
+            lo = value
+        if seen > hi_pos:
+            return int((lo + value) / 2)
+
+
 class Relation:
     """ relation between two companies """
 
     a: Company
     b: str
-    _users: set
+    _users: dict
     nusers: int
     mean: float
     median: float
@@ -37,14 +54,24 @@ class Relation:
 
     count: int
 
-    def __init__(self, a: Company, b: str):
+    def __init__(self, a: Company, b: str, reviews_per_user: dict = None):
         self.a = a
         self.b = b
         self.count = 0
         self._calculated = False
-        self._users = set()
-        self._aratings = list()
-        self._bratings = list()
+        # users in order of first hit (dict as ordered set), so users() and explain are reproducible
+        self._users = dict()
+        # running sums, updated on each hit, so calc() does not touch users
+        self._arating_sum = 0
+        self._brating_sum = 0
+        # reviews without rating are not counted in averages
+        self._arating_n = 0
+        self._brating_n = 0
+        # histogram of users' number of reviews (nreviews -> nusers) for mean/median
+        self._rpu = Counter()
+        self._rpu_sum = 0
+        # shared with RelationDict: public_id -> nreviews for all users of all relations
+        self._reviews_per_user = reviews_per_user
         self.nusers = 0
         self.mean = None
         self.median = None
@@ -58,9 +85,19 @@ class Relation:
         if user in self._users:
             # print(f"ALREADY EXISTS {user} for {self.b}")
             pass
-        self._users.add(user)
-        self._aratings.append(a_rating)
-        self._bratings.append(b_rating)
+        else:
+            self._users[user] = None
+            nreviews = user.nreviews()
+            self._rpu[nreviews] += 1
+            self._rpu_sum += nreviews
+            if self._reviews_per_user is not None:
+                self._reviews_per_user[user.public_id] = nreviews
+        if a_rating is not None:
+            self._arating_sum += a_rating
+            self._arating_n += 1
+        if b_rating is not None:
+            self._brating_sum += b_rating
+            self._brating_n += 1
         self.nusers = len(self._users)
         users_added += 1
 
@@ -68,21 +105,16 @@ class Relation:
         if self._calculated:
             return
 
-        user_reviews = list()
-
-        for u in self._users:
-            user_reviews.append(u.nreviews())
-
-        if not user_reviews:
+        if not self.nusers:
             print("no users for relation to", self.b)
             print("count:", self.count)
             return
 
-
-        self.mean = round(float(np.mean(user_reviews)), 3)
-        self.median = int(np.median(user_reviews))
-        self.avg_arating = round(float(np.mean(self._aratings)), 1)
-        self.avg_brating = round(float(np.mean(self._bratings)), 1)
+        self.mean = round(self._rpu_sum / self.nusers, 3)
+        self.median = hist_median(self._rpu, self.nusers)
+        # 0 if no rated reviews (never high)
+        self.avg_arating = round(self._arating_sum / self._arating_n, 1) if self._arating_n else 0.0
+        self.avg_brating = round(self._brating_sum / self._brating_n, 1) if self._brating_n else 0.0
 
         self._calculated = True
 
@@ -158,18 +190,27 @@ class Relation:
     def __repr__(self):
         if not self._calculated:
             self.calc()
-        bcompany = Company(self.b)
-        return f"{bcompany.get_title()} ({bcompany.address}): hits: {len(self._users)}/{self.count} mean: {self.mean} median: {self.median})"
+        binfo = CompanyInfo.lookup(self.b) or CompanyInfo(self.b)
+        return f"{binfo.get_title()} ({binfo.address}): hits: {len(self._users)}/{self.count} mean: {self.mean} median: {self.median})"
 
-    def hit(self, arating: int, r: Review):
-        """ add review to relation """
+    def hit(self, arating: int, user, brating: int):
+        """ add review of user (rated A with arating) to B """
         self.inc()
-        self.add_user(r.user, arating, r.rating)
+        self.add_user(user, arating, brating)
 
-        if self.btitle is None:
-            self.btitle = r.title
-            self.baddr = r.address
-            # print(f'hit rel to {self.b} {self.btitle} ({self.baddr})')
+    def set_stats(self, count: int, users: list, mean: float, median: int, avg_arating: float, avg_brating: float):
+        """ set already calculated relation (see ReviewMatrix.co_reviews), instead of hit() for each review """
+        self.count = count
+        self._users = dict.fromkeys(users)
+        self.nusers = len(self._users)
+        if self._reviews_per_user is not None:
+            for u in self._users:
+                self._reviews_per_user[u.public_id] = u.nreviews()
+        self.mean = round(mean, 3)
+        self.median = median
+        self.avg_arating = round(avg_arating, 1)
+        self.avg_brating = round(avg_brating, 1)
+        self._calculated = True
 
 
 class RelationDict:
@@ -199,17 +240,34 @@ class RelationDict:
         self.ndangerous = None
         self.dangerous_users = set()
         self.nrisk_users = None
+        # public_id -> nreviews of all users in all relations, filled by Relation
+        self.reviews_per_user = dict()
 
     def __getitem__(self, oid) -> Relation:
         if oid not in self.relations:
-            self.relations[oid] = Relation(self.c, oid)
+            self.relations[oid] = Relation(self.c, oid, reviews_per_user=self.reviews_per_user)
         return self.relations[oid]
 
+    def load_co_reviews(self, co: CoReviews, users: list):
+        """ fill relations from ReviewMatrix.co_reviews() result, users are matrix rows """
+        for idx, oid in enumerate(co.oids):
+            self[oid].set_stats(int(co.count[idx]), [ users[row] for row in co.user_rows[idx].tolist() ],
+                float(co.mean[idx]), int(co.median[idx]), float(co.avg_arating[idx]), float(co.avg_brating[idx]))
+
+    def resolve_titles(self):
+        """ set btitle/baddr for all relations in one LMDB transaction """
+        unresolved = [ oid for oid, rel in self.relations.items() if rel.btitle is None ]
+        for oid, (title, address) in Company.resolve_oids(unresolved).items():
+            self.relations[oid].btitle = title
+            self.relations[oid].baddr = address
+
     def calc(self):        
         if self.meanmedian:
             # already calculated
             return
         
+        self.resolve_titles()
+
         self.ndangerous = 0
         medianlist = list()
         for k, rel in self.relations.items():
@@ -225,12 +283,7 @@ class RelationDict:
             self.meanmedian = 0
             self.doublemedian = 0
         
-        reviews_per_user = dict()
-        for rel in self.relations.values():
-            for u in rel.users():
-                if u.public_id not in reviews_per_user:
-                    reviews_per_user[u.public_id] = u.nreviews()
-
+        reviews_per_user = self.reviews_per_user
         if reviews_per_user:
             self.nusers = len(reviews_per_user)
             self.nreviews = sum(reviews_per_user.values())
@@ -267,6 +320,17 @@ class RelationDict:
 
 
 
+    def top(self, min_count: int, limit: int = None) -> list[Relation]:
+        """ relations with count >= min_count, by count (desc), first limit of them
+
+            only relations above threshold are sorted, heap is used if limit is given
+        """
+        candidates = (rel for rel in self.relations.values() if rel.count >= min_count)
+        if limit:
+            # same order as sorted(), ties in insertion order
+            return heapq.nlargest(limit, candidates, key=lambda rel: rel.count)
+        return sorted(candidates, key=lambda rel: rel.count, reverse=True)
+
     def dump_table(self):
         console = Console()
         table = Table(show_header=True, header_style="bold magenta", title=f"{self.c.get_title()} ({self.c.address}) {self.c.object_id}")
@@ -279,12 +343,17 @@ class RelationDict:
         table.add_column("Median")
         table.add_column("Rating")
 
-        for rel in sorted(self.relations.values(), key=lambda x: x.count, reverse=True):
-            rel.calc()
-            # hide if not dangerous and low count
-            if not rel.is_dangerous() and rel.count < settings.show_hit_th:
+        self.calc()
+
+        # dangerous relations have count >= risk_hit_th
+        shown = [ rel for rel in self.top(min(settings.show_hit_th, settings.risk_hit_th))
+                  if rel.is_dangerous() or rel.count >= settings.show_hit_th ]
+        companies = CompanyInfo.lookup_many(rel.b for rel in shown)
+
+        for rel in shown:
+            _c = companies.get(rel.b)
+            if _c is None:
                 continue
-            _c = Company(rel.b)
 
             if rel.is_dangerous():
                 tags_cell = Text(f"{_c.tags or ''}*")
@@ -317,17 +386,18 @@ class RelationDict:
     def export(self):
         rellist = list()
 
-        for rel in sorted(self.relations.values(), key=lambda x: x.count, reverse=True):
-            rel.calc()
-            # hide if not dangerous and low count
-            if rel.count < min(settings.show_hit_th, settings.risk_hit_th):
-                continue
+        self.calc()
+
+        # hide if not dangerous and low count
+        top = self.top(min(settings.show_hit_th, settings.risk_hit_th), limit=settings.max_report_relations)
+        companies = CompanyInfo.lookup_many(rel.b for rel in top)
 
-            try:
-                _c = Company(rel.b)
-            except (AFNoCompany, AFCompanyError):
-                # print(f"Ignore NO-COMPANY {rel.b} with {rel.count} hits")
+        for rel in top:
+            _c = companies.get(rel.b)
+            if _c is None:
+                # not a company (e.g. geo object)
                 continue
+
             data = dict()
             data['tags'] = _c.tags
             data['title'] = _c.get_title()
@@ -341,5 +411,3 @@ class RelationDict:
             data['risk'] = rel.is_risk()
             rellist.append(data)
         return rellist
-
-
@@ -1,13 +1,14 @@
 import datetime
 from rich import print_json
 
+from .utils import date_to_day, today
+
 class Review():
 
     _user: 'User'
 
-    def __init__(self, data, user=None, company=None):
+    def __init__(self, data, user=None, company=None, objinfo=None):
         # data is either from our local db or from 2gis company
-        from .company import Company
 
         self._data = data
         
@@ -24,35 +25,55 @@ class Review():
         self._company = company
         self.user_age = None
 
-        date = data.get('date_created') or data['created']
-
-        if 'T' in date:
-            self.created = datetime.datetime.strptime(date.split('.')[0], "%Y-%m-%dT%H:%M:%S")
-        else:
-            self.created = datetime.datetime.strptime(date, "%Y-%m-%d")
-        # self.created = datetime.datetime.strptime(data['date_created'].split('T')[0], "%Y-%m-%d")
+        self._date = data.get('date_created') or data['created']
 
-        # age from today (grows every time)
-        self.age = (datetime.datetime.now() - self.created).days
+        # day number, parsed once when review is stored/loaded, see utils.date_to_day
+        self.created_day = data.get('created_day')
+        if self.created_day is None:
+            self.created_day = date_to_day(self._date)
 
-        
+        # age from today (same 'today' for whole run)
+        self.age = today() - self.created_day
 
         if user:
             self.set_user(user)
         
 
-        self.title, self.address = Company.resolve_oid(self.oid)
+        # (title, address), resolved on first use
+        self._objinfo = objinfo
+
+    @property
+    def title(self):
+        return self.objinfo[0]
+
+    @property
+    def address(self):
+        return self.objinfo[1]
+
+    @property
+    def objinfo(self):
+        if self._objinfo is None:
+            from .company import Company
+            self._objinfo = Company.resolve_oid(self.oid)
+        return self._objinfo
 
     def set_user(self, user):
         self._user = user
         if self._user.birthday():
             # set only for public profile
-            self.user_age = (self.created - self._user.birthday()).days
+            self.user_age = self.created_day - self._user.birthday_day()
+
+    @property
+    def created(self) -> datetime.datetime:
+        if 'T' in self._date:
+            return datetime.datetime.strptime(self._date.split('.')[0], "%Y-%m-%dT%H:%M:%S")
+        else:
+            return datetime.datetime.strptime(self._date, "%Y-%m-%d")
 
 
     @property
     def created_str(self):
-        return self.created.strftime("%Y-%m-%d")
+        return self._date[:10]
 
     @property    
     def user(self) -> 'User': 
@@ -0,0 +1,154 @@
+import numpy as np
+
+from .userrecord import REVIEW_DTYPE, rated
+
+"""
+    Sparse user x company matrix of ratings (CSR, numpy only).
+
+    row i is users[i], its entries are indptr[i]:indptr[i+1] in indices (company column, see oids)
+    and ratings, in same order as User.columns().
+
+    Relations of company A are a row product: take rows of users who reviewed A, group their entries
+    by company and reduce (bincount, sorted segments) instead of Relation.hit() for each review.
+    Many target companies can be processed in one pass (co_reviews() with many targets).
+"""
+
+
+class CoReviews:
+    """ co-reviewed companies of one target, arrays in order of first occurrence (like RelationDict insertion) """
+
+    oids: list
+    count: np.ndarray
+    nusers: np.ndarray
+    mean: np.ndarray
+    median: np.ndarray
+    avg_arating: np.ndarray
+    avg_brating: np.ndarray
+    # for each company, array of matrix rows (users) in order of first review
+    user_rows: list
+
+    def __len__(self):
+        return len(self.oids)
+
+
+class ReviewMatrix:
+
+    def __init__(self, users: list):
+        self.users = users
+        self.nrows = len(users)
+
+        cols = [ u.columns() for u in users ]
+        lengths = np.array([ len(c) for c in cols ], dtype=np.int64)
+
+        self.indptr = np.zeros(self.nrows + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.indptr[1:])
+
+        allcols = np.concatenate(cols) if cols else np.empty(0, dtype=REVIEW_DTYPE)
+        self.oids, self.indices = np.unique(allcols['oid'], return_inverse=True)
+        self.indices = self.indices.reshape(-1)
+        self.ratings = allcols['rating'].astype(np.int64)
+        # reviews with rating (NO_RATING is not averaged)
+        self.rated = rated(allcols['rating'])
+
+        # reviews per user (all reviews, as User.nreviews())
+        self.nreviews = np.array([ u.nreviews() for u in users ], dtype=np.int64)
+
+    def row_entries(self, rows: np.ndarray):
+        """ entries (positions in indices/ratings) of rows, and row number of each entry """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        total = int(lengths.sum())
+
+        # position inside own row for each entry
+        offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return np.repeat(starts, lengths) + offsets, np.repeat(rows, lengths), lengths
+
+    def co_reviews(self, targets: dict) -> dict:
+        """ targets: oid -> (rows, aratings) where aratings are ratings of target company by these users (or None)
+
+            returns oid -> CoReviews
+        """
+        ncols = len(self.oids)
+        target_oids = list(targets)
+
+        parts_entry = list()
+        parts_row = list()
+        parts_target = list()
+        parts_arating = list()
+
+        for tidx, oid in enumerate(target_oids):
+            rows, aratings = targets[oid]
+            entry, row, lengths = self.row_entries(rows)
+            aratings = np.array([ np.nan if a is None else a for a in aratings ], dtype=float)
+            arating = np.repeat(aratings, lengths)
+
+            # skip reviews of target itself
+            keep = self.oids[self.indices[entry]] != np.uint64(int(oid))
+
+            parts_entry.append(entry[keep])
+            parts_row.append(row[keep])
+            parts_target.append(np.full(int(keep.sum()), tidx, dtype=np.int64))
+            parts_arating.append(arating[keep])
+
+        entry = np.concatenate(parts_entry) if parts_entry else np.empty(0, dtype=np.int64)
+        row = np.concatenate(parts_row) if parts_row else np.empty(0, dtype=np.int64)
+        target = np.concatenate(parts_target) if parts_target else np.empty(0, dtype=np.int64)
+        arating = np.concatenate(parts_arating) if parts_arating else np.empty(0, dtype=float)
+        brating = self.ratings[entry]
+        brated = self.rated[entry]
+        arated = ~np.isnan(arating)
+
+        # group is (target, company)
+        key = target * ncols + self.indices[entry]
+        gkeys, first, ginv = np.unique(key, return_index=True, return_inverse=True)
+        ginv = ginv.reshape(-1)
+        ngroups = len(gkeys)
+
+        count = np.bincount(ginv, minlength=ngroups)
+        asum = np.bincount(ginv, weights=np.where(arated, arating, 0), minlength=ngroups)
+        acount = np.bincount(ginv, weights=arated, minlength=ngroups)
+        bsum = np.bincount(ginv, weights=np.where(brated, brating, 0), minlength=ngroups)
+        bcount = np.bincount(ginv, weights=brated, minlength=ngroups)
+
+        # unique users of group (and their first entry), sorted by group then by user reviews
+        pairs, pfirst = np.unique(ginv * max(self.nrows, 1) + row, return_index=True)
+        pgroup = pairs // max(self.nrows, 1)
+        prow = pairs % max(self.nrows, 1)
+        prpu = self.nreviews[prow]
+        order = np.lexsort((prpu, pgroup))
+        pgroup, prow, prpu, pfirst = pgroup[order], prow[order], prpu[order], pfirst[order]
+
+        nusers = np.bincount(pgroup, minlength=ngroups)
+        rpusum = np.bincount(pgroup, weights=prpu, minlength=ngroups)
+        gstart = np.cumsum(nusers) - nusers
+
+        # median as int(np.median()): mean of two middle values for even size
+        lo = prpu[gstart + (nusers - 1) // 2] if ngroups else np.empty(0, dtype=np.int64)
+        hi = prpu[gstart + nusers // 2] if ngroups else np.empty(0, dtype=np.int64)
+        median = ((lo + hi) / 2).astype(np.int64)
+
+        # users of group in order of first review (as Relation.hit() adds them)
+        first_order = np.lexsort((pfirst, pgroup))
+        user_rows = np.split(prow[first_order], gstart[1:]) if ngroups else list()
+
+        result = dict()
+        gtarget = gkeys // max(ncols, 1)
+        for tidx, oid in enumerate(target_oids):
+            # groups of this target, in order of first occurrence
+            groups = np.flatnonzero(gtarget == tidx)
+            groups = groups[np.argsort(first[groups], kind='stable')]
+
+            co = CoReviews()
+            co.oids = [ str(x) for x in self.oids[gkeys[groups] % ncols].tolist() ] if len(groups) else list()
+            co.count = count[groups]
+            co.nusers = nusers[groups]
+            co.mean = rpusum[groups] / nusers[groups]
+            co.median = median[groups]
+            # 0 if no rated reviews, as Relation.calc()
+            co.avg_arating = np.divide(asum[groups], acount[groups], out=np.zeros(len(groups)), where=acount[groups] > 0)
+            co.avg_brating = np.divide(bsum[groups], bcount[groups], out=np.zeros(len(groups)), where=bcount[groups] > 0)
+            co.user_rows = [ user_rows[g] for g in groups.tolist() ]
+            result[oid] = co
+
+        return result
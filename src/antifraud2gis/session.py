@@ -1,5 +1,108 @@
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
 from .settings import settings
+from .statistics import statistics
+
+"""
+    Shared requests session for 2GIS APIs.
+
+    - connection pool per host sized by settings (HTTP_POOL_CONNECTIONS, HTTP_POOL_SIZE), so threads
+      (page prefetch, company prefetch) reuse keep-alive connections instead of opening new TLS connections
+    - urllib3 Retry with backoff for connection/read errors (HTTP_RETRIES, HTTP_BACKOFF),
+      429/5xx responses are handled by callers (ratelimit.Endpoint)
+    - default timeout HTTP_TIMEOUT
+    - timing metrics in statistics: new connections, connect time (DNS + TCP), tunnel + TLS time
+      (CONNECT via HTTPS_PROXY and handshake), response time (to headers)
+"""
+
+def record_connect(connect_time: float, tls_time: float):
+    statistics.inc(http_connections=1, http_connect_time=connect_time, http_tls_time=tls_time)
+
+
+def record_response(response_time: float):
+    statistics.inc(http_requests=1, http_response_time=response_time)
+
+
+class TimedConnectionMixin:
+    """ measure connection setup """
+
+    def _new_conn(self):
+        # DNS + TCP connect (to proxy if used)
+        started = time.monotonic()
+        sock = super()._new_conn()
+        self._connect_time = time.monotonic() - started
+        return sock
+
+    def connect(self):
+        started = time.monotonic()
+        self._connect_time = 0
+        super().connect()
+        elapsed = time.monotonic() - started
+        record_connect(self._connect_time, elapsed - self._connect_time)
+
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+    pass
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+POOL_CLASSES = {
+    'http': TimedHTTPConnectionPool,
+    'https': TimedHTTPSConnectionPool
+}
+
+
+class TimedAdapter(HTTPAdapter):
+    """ HTTPAdapter with timed connections and default timeout """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = POOL_CLASSES
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        # SOCKS proxy manager has own connection classes
+        if not proxy.lower().startswith('socks'):
+            manager.pool_classes_by_scheme = POOL_CLASSES
+        return manager
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=timeout or settings.http_timeout, **kwargs)
+
+
+def make_adapter() -> HTTPAdapter:
+    retry = Retry(
+        total=settings.http_retries,
+        backoff_factor=settings.http_backoff,
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        status_forcelist=[],
+        # 429/503 with Retry-After are also returned to caller, not retried here
+        respect_retry_after_header=False,
+        raise_on_status=False
+    )
+    return TimedAdapter(
+        pool_connections=settings.http_pool_connections,
+        pool_maxsize=settings.http_pool_size,
+        max_retries=retry
+    )
+
+
+def _timing_hook(r, *args, **kwargs):
+    record_response(r.elapsed.total_seconds())
+
 
 session = requests.Session()
 
@@ -13,3 +116,7 @@ session.headers.update({
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36"
 })
 
+_adapter = make_adapter()
+session.mount("https://", _adapter)
+session.mount("http://", _adapter)
+session.hooks['response'].append(_timing_hook)
@@ -38,6 +38,8 @@ class Settings():
         # median rpu for relations/printing
         self.risk_median_th = int(os.getenv('RISK_MEDIAN', '15'))
         self.show_hit_th = int(os.getenv('SHOW_HIT', '1000'))
+        # max relations in report (top by hits), 0 for all above threshold
+        self.max_report_relations = int(os.getenv('MAX_REPORT_RELATIONS', '0'))
 
 
 
@@ -69,7 +71,60 @@ class Settings():
         # Other system parameters
         self.proxy = os.getenv('HTTPS_PROXY', None)
 
-
+        # HTTP connections (session.py, crawler.py): pools (hosts) and keep-alive connections per host,
+        # retries with backoff on connection/read errors, timeout, HTTP/2 for crawler (if h2 installed)
+        self.http_pool_connections = int(os.getenv('HTTP_POOL_CONNECTIONS', '10'))
+        self.http_pool_size = int(os.getenv('HTTP_POOL_SIZE', '16'))
+        self.http_retries = int(os.getenv('HTTP_RETRIES', '3'))
+        self.http_backoff = float(os.getenv('HTTP_BACKOFF', '0.5'))
+        self.http_timeout = float(os.getenv('HTTP_TIMEOUT', '30'))
+        self.http2 = bool(int(os.getenv('HTTP2', '1')))
+
+        # how many object: records (title/address) keep in memory
+        self.object_cache_size = int(os.getenv('OBJECT_CACHE_SIZE', '100000'))
+
+        # columnar batch detection (fd/table.py), default is to feed reviews one by one
+        # (parity with streaming path: tests/test_batch_detect.py)
+        self.batch_detect = bool(int(os.getenv('BATCH_DETECT', '0')))
+
+        # 2GIS APIs (can be pointed to local stub server)
+        self.user_feed_url = os.getenv('USER_FEED_URL', 'https://api.auth.2gis.com/public-profile/1.1/user/{public_id}/content/feed')
+        self.reviews_api_url = os.getenv('REVIEWS_API_URL', 'https://public-api.reviews.2gis.com/2.0')
+
+        # attempts for each API request on 429/5xx/network errors
+        self.network_retries = int(os.getenv('NETWORK_RETRIES', '5'))
+        # requests per second to reviews / public-profile API for all workers together (0 - no limit)
+        self.reviews_rate = float(os.getenv('REVIEWS_RATE', '5'))
+        self.profile_rate = float(os.getenv('PROFILE_RATE', '10'))
+        self.rate_burst = float(os.getenv('RATE_BURST', '5'))
+        # pause API for CIRCUIT_COOLDOWN seconds after CIRCUIT_THRESHOLD errors in a row
+        self.circuit_threshold = int(os.getenv('CIRCUIT_THRESHOLD', '10'))
+        self.circuit_cooldown = int(os.getenv('CIRCUIT_COOLDOWN', '60'))
+        # refresh cached company reviews older than N days (delta, only new reviews) when loaded, 0 - never
+        self.company_stale_days = int(os.getenv('COMPANY_STALE_DAYS', '0'))
+        # update stored users fetched more than N days ago (only new reviews) when company users are loaded, 0 - never
+        self.user_stale_days = int(os.getenv('USER_STALE_DAYS', '0'))
+        # company review pages requested ahead, companies loaded in parallel (explore)
+        self.page_prefetch = int(os.getenv('PAGE_PREFETCH', '3'))
+        self.company_prefetch = int(os.getenv('COMPANY_PREFETCH', '4'))
+
+        # async user crawler (crawler.py): parallel requests, requests per second per host (0 - no limit), users per LMDB write
+        self.crawl_concurrency = int(os.getenv('CRAWL_CONCURRENCY', '16'))
+        self.crawl_rate = float(os.getenv('CRAWL_RATE', '10'))
+        self.crawl_batch = int(os.getenv('CRAWL_BATCH', '50'))
+
+
+
+        # af2worker: dramatiq processes and threads per process, OID lock ttl (sec, renewed while detection runs,
+        # so task of crashed worker can be taken over soon)
+        self.worker_processes = int(os.getenv('WORKER_PROCESSES', '1'))
+        self.worker_threads = int(os.getenv('WORKER_THREADS', '1'))
+        self.task_lock_ttl = int(os.getenv('TASK_LOCK_TTL', '120'))
+        # task state (af2gis:task:<oid>) lifetime while queued and after done (sec)
+        self.task_state_ttl = int(os.getenv('TASK_STATE_TTL', str(7*24*3600)))
+        self.task_done_ttl = int(os.getenv('TASK_DONE_TTL', '600'))
+        # concurrent LMDB read transactions (all processes and threads)
+        self.lmdb_max_readers = int(os.getenv('LMDB_MAX_READERS', '512'))
 
         # web UI
         self.turnstile_sitekey = os.getenv('TURNSTILE_SITEKEY', None)
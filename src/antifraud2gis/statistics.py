@@ -1,4 +1,5 @@
 import dataclasses
+import threading
 
 @dataclasses.dataclass
 class Statistics:
@@ -8,6 +9,31 @@ class Statistics:
     total_companies_loaded_network: int
     created_new_companies: int = 0
 
+    # HTTP timing (session.py, crawler.py), seconds
+    http_requests: int = 0
+    http_connections: int = 0
+    http_connect_time: float = 0.0
+    http_tls_time: float = 0.0
+    http_response_time: float = 0.0
+
+    _lock: threading.Lock = dataclasses.field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def inc(self, **counters):
+        """ thread-safe increment, e.g. inc(total_users_loaded=1) """
+        with self._lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def http_summary(self):
+        """ average timings in ms """
+        def avg(total, n):
+            return f"{1000 * total / n:.0f}ms" if n else "-"
+
+        return f"HTTP requests: {self.http_requests} new connections: {self.http_connections} " \
+            f"connect: {avg(self.http_connect_time, self.http_connections)} " \
+            f"tunnel+tls: {avg(self.http_tls_time, self.http_connections)} " \
+            f"response: {avg(self.http_response_time, self.http_requests)}"
+
 statistics = Statistics(
     total_users_loaded=0,
     total_companies_loaded=0,
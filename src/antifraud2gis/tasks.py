@@ -3,20 +3,22 @@ import time
 import os
 import redis
 import json
-# from filelock import FileLock, Timeout
+import socket
+import threading
+from contextlib import contextmanager
 from .fraud import detect
-from .company import CompanyList, Company
+from .company import CompanyList, Company, object_cache
 from .exceptions import AFNoCompany, AFReportAlreadyExists, AFCompanyNotFound
 from .logger import logger
 from .const import REDIS_WORKER_STATUS, REDIS_WORKER_STATUS_SET, REDIS_TRUSTED_LIST, REDIS_UNTRUSTED_LIST, \
-    REDIS_TASK_QUEUE_NAME, REDIS_DRAMATIQ_QUEUE
+    REDIS_TASK_QUEUE_NAME, REDIS_BULK_TASK_QUEUE_NAME, REDIS_DRAMATIQ_QUEUE, REDIS_DRAMATIQ_BULK_QUEUE, REDIS_INFLIGHT_PREFIX, \
+    REDIS_TASK_STATE_PREFIX, REDIS_TASK_SEQ, REDIS_TASK_DURATIONS, REDIS_WORKER_CONCURRENCY
+from .settings import settings
 from .user import reset_user_pool
 from .statistics import statistics
 
 broker = dramatiq.get_broker()
 
-lock_path = "/tmp/.antifraud.lock"
-
 r = redis.Redis(
     decode_responses=True
 )
@@ -24,16 +26,121 @@ r = redis.Redis(
 # r.set(REDIS_WORKER_STATUS, f'worker started as pid {os.getpid()}')
 
 started = time.time()
+# tasks processed by this process (all threads)
 processed = 0
+processed_lock = threading.Lock()
+
+RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+release_lock = r.register_script(RELEASE_LOCK_LUA)
+
+# KEYS: lock, task state; ARGV: token, ttl
+RENEW_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+renew_lock = r.register_script(RENEW_LOCK_LUA)
+
+"""
+    Per-OID task state (hash af2gis:task:<oid>): state (queued/running/retry/done), queue (interactive/bulk),
+    force, submitted/started/finished timestamps, result.
+
+    Submission is idempotent: if OID is already queued or running, no new message is sent (web resubmits
+    and overlapping bulk runs coalesce into one job). Forced resubmit of queued task sets force flag,
+    interactive resubmit of task queued in bulk promotes it to interactive queue (bulk message is skipped later).
+
+    Running task keeps OID lock (and state) alive while detection runs. If worker crashed, lock expires in
+    TASK_LOCK_TTL and redelivered message takes task over. If detection raised, state is 'retry': dramatiq
+    retry runs it again, new submission is not coalesced into it.
+
+    Queued OIDs are also indexed in sorted sets (REDIS_TASK_QUEUE_NAME, REDIS_BULK_TASK_QUEUE_NAME) with
+    submission sequence number as score, so queue position is ZRANK (no need to read whole queue).
+    Durations of last detections (REDIS_TASK_DURATIONS) are used to estimate waiting time.
+"""
+
+# KEYS: state, interactive zset, bulk zset, seq; ARGV: queue, force, now, ttl, oid
+# returns 0 (coalesced), 1 (new task), 2 (promoted to interactive)
+SUBMIT_LUA = """
+local state = redis.call('HGET', KEYS[1], 'state')
+if state == 'queued' or state == 'running' then
+    if state == 'queued' and ARGV[2] == '1' then
+        redis.call('HSET', KEYS[1], 'force', '1')
+    end
+    if state == 'queued' and ARGV[1] == 'interactive' and redis.call('HGET', KEYS[1], 'queue') == 'bulk' then
+        redis.call('HSET', KEYS[1], 'queue', 'interactive')
+        redis.call('ZREM', KEYS[3], ARGV[5])
+        redis.call('ZADD', KEYS[2], redis.call('INCR', KEYS[4]), ARGV[5])
+        return 2
+    end
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], 'state', 'queued', 'queue', ARGV[1], 'force', ARGV[2], 'submitted', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+local zkey = KEYS[2]
+if ARGV[1] == 'bulk' then
+    zkey = KEYS[3]
+end
+redis.call('ZADD', zkey, redis.call('INCR', KEYS[4]), ARGV[5])
+return 1
+"""
+submit_task_state = r.register_script(SUBMIT_LUA)
+
+# KEYS: state, OID lock; ARGV: queue, now, ttl
+# returns force flag ('0'/'1') if this message should run detection, nil otherwise
+CLAIM_LUA = """
+local state = redis.call('HGET', KEYS[1], 'state')
+if state == 'done' then
+    return false
+end
+if state == 'running' and redis.call('EXISTS', KEYS[2]) == 1 then
+    -- running by live worker (lock of crashed worker expires)
+    return false
+end
+if state == 'queued' and redis.call('HGET', KEYS[1], 'queue') ~= ARGV[1] then
+    -- promoted, will run from other queue
+    return false
+end
+redis.call('HSET', KEYS[1], 'state', 'running', 'queue', ARGV[1], 'started', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return redis.call('HGET', KEYS[1], 'force') or '0'
+"""
+claim_task_state = r.register_script(CLAIM_LUA)
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+# ETA is estimated from this number of last detections
+TASK_DURATIONS_N = 20
 
-def get_qsize():
-    return r.llen(REDIS_DRAMATIQ_QUEUE)    
+"""
+    Two dramatiq queues:
+        default (interactive): web submissions, fraud_task, priority 0
+        bulk: CLI submissions (submitfraud, explore), bulk_fraud_task, priority 100
+
+    Worker consumes both queues, but prefetched messages are executed in priority order,
+    so interactive task waits only for tasks already running, not for whole bulk queue.
+"""
+
+BULK_QUEUE = "bulk"
+INTERACTIVE_PRIORITY = 0
+BULK_PRIORITY = 100
+
+def get_qsize(queue: str = REDIS_DRAMATIQ_QUEUE):
+    return r.llen(queue)
 
 def cooldown_queue(maxq: int):
+    """ wait until bulk queue is shorter than maxq (interactive tasks do not delay bulk submissions) """
     printed = False
-    while get_qsize() >= maxq:
+    while get_qsize(REDIS_DRAMATIQ_BULK_QUEUE) >= maxq:
         if not printed:
-            logger.debug(f"Queue size {get_qsize()} > {maxq}, waiting to cooldown...")
+            logger.debug(f"Bulk queue size {get_qsize(REDIS_DRAMATIQ_BULK_QUEUE)} > {maxq}, waiting to cooldown...")
             printed = True
         time.sleep(10)
 
@@ -41,15 +148,129 @@ def set_status(status: str):
     r.set(REDIS_WORKER_STATUS, status)
     r.set(REDIS_WORKER_STATUS_SET, str(int(time.time())))
 
-@dramatiq.actor
+@dramatiq.actor(priority=INTERACTIVE_PRIORITY)
 def fraud_task(oid: str, force=False):
+    """ interactive (web) request """
+    r.zrem(REDIS_TASK_QUEUE_NAME, oid)
+    run_fraud_task(oid, force=force, queue=INTERACTIVE)
+
+@dramatiq.actor(queue_name=BULK_QUEUE, priority=BULK_PRIORITY)
+def bulk_fraud_task(oid: str, force=False):
+    """ bulk (CLI) request, runs when no interactive tasks are waiting """
+    r.zrem(REDIS_BULK_TASK_QUEUE_NAME, oid)
+    run_fraud_task(oid, force=force, queue=BULK)
+
+@contextmanager
+def inflight_lock(oid: str):
+    """ yields True if we own oid lock (no other worker thread/process runs detection for it), False otherwise """
+    key = REDIS_INFLIGHT_PREFIX + oid
+    token = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+    if not r.set(key, token, nx=True, ex=settings.task_lock_ttl):
+        yield False
+        return
+
+    stop = threading.Event()
+
+    def renew():
+        # renew lock and task state ttl, so they expire only if this worker dies
+        while not stop.wait(settings.task_lock_ttl / 3):
+            try:
+                renew_lock(keys=[key, REDIS_TASK_STATE_PREFIX + oid], args=[token, settings.task_lock_ttl])
+            except redis.RedisError as e:
+                logger.warning(f"Worker: cannot renew lock for {oid!r}: {e}")
+
+    renewer = threading.Thread(target=renew, daemon=True)
+    renewer.start()
+    try:
+        yield True
+    finally:
+        stop.set()
+        renewer.join()
+        # delete only our lock (it could expire and be taken by other worker)
+        release_lock(keys=[key], args=[token])
+
+def get_task_state(oid: str) -> dict:
+    """ task state hash (empty dict if unknown or expired) """
+    return r.hgetall(REDIS_TASK_STATE_PREFIX + oid)
+
+def queue_position(oid: str) -> dict:
+    """ task state with queue position (interactive tasks go first), queue sizes and ETA (sec or None) """
+    with r.pipeline() as pipe:
+        pipe.hgetall(REDIS_TASK_STATE_PREFIX + oid)
+        pipe.zrank(REDIS_TASK_QUEUE_NAME, oid)
+        pipe.zrank(REDIS_BULK_TASK_QUEUE_NAME, oid)
+        pipe.zcard(REDIS_TASK_QUEUE_NAME)
+        pipe.zcard(REDIS_BULK_TASK_QUEUE_NAME)
+        pipe.lrange(REDIS_TASK_DURATIONS, 0, -1)
+        pipe.get(REDIS_WORKER_CONCURRENCY)
+        tstate, rank, bulk_rank, qsize, bulk_qsize, durations, concurrency = pipe.execute()
+
+    if rank is not None:
+        qpos = rank + 1
+    elif bulk_rank is not None:
+        qpos = qsize + bulk_rank + 1
+    else:
+        qpos = None
+
+    eta = None
+    if durations:
+        avg = sum(map(float, durations)) / len(durations)
+        if tstate.get('state') == 'running':
+            eta = max(0, avg - (time.time() - int(tstate.get('started', 0))))
+        elif qpos is not None:
+            # tasks before us and ours, processed by all worker threads in parallel
+            eta = avg * (qpos // max(1, int(concurrency or 1)) + 1)
+
+    return {
+        'state': tstate,
+        'qpos': qpos,
+        'qsize': qsize,
+        'bulk_qsize': bulk_qsize,
+        'eta': eta
+    }
+
+def finish_task_state(oid: str, result: str):
+    key = REDIS_TASK_STATE_PREFIX + oid
+    with r.pipeline() as pipe:
+        pipe.hset(key, mapping={'state': 'done', 'result': result, 'finished': int(time.time())})
+        pipe.expire(key, settings.task_done_ttl)
+        pipe.execute()
+
+def retry_task_state(oid: str):
+    """ detection raised, dramatiq will retry it (new submission starts new task) """
+    key = REDIS_TASK_STATE_PREFIX + oid
+    with r.pipeline() as pipe:
+        pipe.hset(key, mapping={'state': 'retry', 'result': 'error', 'finished': int(time.time())})
+        pipe.expire(key, settings.task_state_ttl)
+        pipe.execute()
+
+def run_fraud_task(oid: str, force=False, queue: str = INTERACTIVE):
+    claimed = claim_task_state(keys=[REDIS_TASK_STATE_PREFIX + oid, REDIS_INFLIGHT_PREFIX + oid],
+                               args=[queue, int(time.time()), settings.task_lock_ttl])
+    if claimed is None:
+        logger.info(f"Worker: {oid!r} is already running, done or promoted to other queue, skip")
+        return
+    # force could be set by coalesced submission
+    force = force or claimed == '1'
+
+    with inflight_lock(oid) as locked:
+        if not locked:
+            # task state belongs to worker which runs it
+            logger.warning(f"Worker: {oid!r} is already processed by {r.get(REDIS_INFLIGHT_PREFIX + oid)}, skip")
+            return
+        try:
+            created = _run_fraud_task(oid, force=force)
+        except BaseException:
+            # also dramatiq interrupts (time limit, shutdown)
+            retry_task_state(oid)
+            raise
+        finish_task_state(oid, 'ok' if created else 'failed')
+
+def _run_fraud_task(oid: str, force=False) -> bool:
+    """ True if report is created """
     global processed
-    #lock = FileLock(lock_path)
 
     task_started = time.time()
-
-    #with lock.acquire():
-    r.lrem(REDIS_TASK_QUEUE_NAME, count=1, value=oid)
     
     try:
         c = Company(oid)
@@ -100,14 +321,35 @@ def fraud_task(oid: str, force=False):
     r.lpush(lname, json.dumps(res))
     r.ltrim(lname, 0, 19)
     reset_user_pool()
-    processed += 1
+    with processed_lock:
+        processed += 1
+        total = processed
+
+    duration = time.time() - task_started
+    with r.pipeline() as pipe:
+        pipe.lpush(REDIS_TASK_DURATIONS, round(duration, 1))
+        pipe.ltrim(REDIS_TASK_DURATIONS, 0, TASK_DURATIONS_N - 1)
+        pipe.execute()
 
-    logger.info(f"Worker: {oid!r} processed in {int(time.time() - task_started)} sec")
-    logger.info(f"Worker total: {processed} tasks in {int(time.time() - started)} sec")
+    logger.info(f"Worker: {oid!r} processed in {int(duration)} sec")
+    logger.info(f"Worker total: {total} tasks in {int(time.time() - started)} sec")
     logger.info(statistics)
+    logger.info(f"Object cache: {object_cache}")
+    return True
 
 
-def submit_fraud_task(oid: str, force: bool = False):
-    fraud_task.send(oid, force=force)
-    r.rpush(REDIS_TASK_QUEUE_NAME, oid)
+def submit_fraud_task(oid: str, force: bool = False, bulk: bool = False) -> bool:
+    """ send task unless same oid is already queued or running, returns True if message is sent """
+    queue = BULK if bulk else INTERACTIVE
+    status = submit_task_state(keys=[REDIS_TASK_STATE_PREFIX + oid, REDIS_TASK_QUEUE_NAME, REDIS_BULK_TASK_QUEUE_NAME, REDIS_TASK_SEQ],
+                               args=[queue, int(force), int(time.time()), settings.task_state_ttl, oid])
+    if status == 0:
+        logger.debug(f"Task {oid!r} is already queued or running, coalesced")
+        return False
+
+    if bulk:
+        bulk_fraud_task.send(oid, force=force)
+    else:
+        fraud_task.send(oid, force=force)
+    return True
 
@@ -3,6 +3,8 @@ import requests
 import json
 from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
 import time
+import random
+import threading
 import functools
 from rich.pretty import Pretty
 from rich import print_json
@@ -10,22 +12,38 @@ import traceback
 import sys
 import datetime
 import gzip
-import lmdb
 import tempfile
 import os
+import numpy as np
 
 from .db import db
-from .const import WSS_THRESHOLD, LOAD_NREVIEWS, SLEEPTIME, LMDB_MAP_SIZE
+from .const import WSS_THRESHOLD, LOAD_NREVIEWS, SLEEPTIME
 from .settings import settings
 from .statistics import statistics
 from .session import session
+from .lmdbenv import lmdb_get, lmdb_getmulti, read_txn, write_txn, prefix_iter
 from .review import Review
+from .userrecord import encode_user, UserRecord, REVIEW_DTYPE
+from .utils import date_to_day, day_to_datetime
 from .logger import logger
+from .ratelimit import profile_api, is_throttled, retry_after, backoff_delay
+from .exceptions import AFNetworkError
 
 THRESHOLD_NR=3
 THRESHOLD_TS=1.5
 
-user_pool = dict()
+USERMETA_PREFIX = b'usermeta:'
+FEED_PAGE_SIZE = 20
+
+# users loaded for current detection, separate for each thread (worker may run many tasks in threads)
+_pool = threading.local()
+
+def _user_pool() -> dict:
+    try:
+        return _pool.users
+    except AttributeError:
+        _pool.users = dict()
+        return _pool.users
 
 def retry(max_attempts=3, delay=1):
     def decorator(func):
@@ -36,19 +54,37 @@ def retry(max_attempts=3, delay=1):
                     return func(*args, **kwargs)
                 except Exception as e:
                     print(f"Attempt {attempt + 1} failed: {e}")
-                    time.sleep(delay)
+                    time.sleep(backoff_delay(attempt, base=delay))
             raise RuntimeError(f"Function {func.__name__} failed after {max_attempts} attempts")
         return wrapper
     return decorator
 
 
 class User:
-    def __init__(self, public_id):
+    def __init__(self, public_id, data: bytes = None):
 
         self.public_id = public_id
         self.reviews_path = settings.user_storage / (public_id + '-reviews.json.gz')
-        self._reviews = list()
-        self.load(local_only=True)
+        self._set_record(None)
+        if data:
+            # already read from LMDB by caller (see load_users())
+            self._set_record(UserRecord(public_id, data))
+        else:
+            self.load(local_only=True)
+
+    def _set_record(self, record: UserRecord):
+        self._record = record
+        # no record: not in LMDB ('local'), or not in LMDB and not loaded from network ('network', private)
+        self._missing = None
+        # values derived from record (sorted reviews, birthday...), calculated once per load
+        self._memo = dict()
+
+    @property
+    def _reviews(self) -> list:
+        """ review dicts (LMDB format), built only when needed """
+        if self._record is None:
+            return list()
+        return self._record.reviews()
 
     def lmdb_load(self, local_only=False):
         # prepare data structures
@@ -58,24 +94,34 @@ class User:
         # print("ZZZ lmdb_load", self.public_id, local_only)
         # print("".join(traceback.format_stack(limit=10)))
         
-        env = lmdb.open(settings.lmdb_storage.as_posix(), map_size=LMDB_MAP_SIZE)
+        if self._record is not None or self._missing == 'network' or (self._missing == 'local' and local_only):
+            # already loaded or known to be missing
+            return
 
-        with env.begin() as txn:
-            val = txn.get(b"user:" + self.public_id.encode())
+        if self._missing is None:
+            val = lmdb_get(b"user:" + self.public_id.encode())
             if val:
-                self._reviews = json.loads(val)
+                self._set_record(UserRecord(self.public_id, val))
                 return
+            self._missing = 'local'
 
-            # not found in db
-            if local_only is False:                
-                loaded = False
-                while not loaded:
-                    try:
-                        self.load_from_network()
-                        loaded = True
-                    except Exception as e:
-                        print(f"Error loading user {self.public_id}: {type(e)} {e}")
-                        time.sleep(5)
+        # not found in db
+        if local_only is False:
+            for attempt in range(settings.network_retries):
+                try:
+                    self.load_from_network()
+                    if self._record is None:
+                        # private profile
+                        self._missing = 'network'
+                    return
+                except AFNetworkError:
+                    # throttle retries are already used (and reported) by load_from_network
+                    raise
+                except Exception as e:
+                    print(f"Error loading user {self.public_id}: {type(e)} {e}")
+                    profile_api.failed()
+                    time.sleep(backoff_delay(attempt))
+            raise AFNetworkError(f"Cannot load user {self.public_id} after {settings.network_retries} attempts")
 
 
 
@@ -88,9 +134,9 @@ class User:
             return
         
         if self.reviews_path.exists():
-            with gzip.open(self.reviews_path, "rt") as f:
+            with gzip.open(self.reviews_path, "rb") as f:
                 try:
-                    self._reviews = json.load(f)
+                    self._set_record(UserRecord(self.public_id, f.read()))
                 except json.JSONDecodeError:
                     print("Cannot parse JSON!")
                     print(self.reviews_path)
@@ -106,63 +152,51 @@ class User:
                         print(f"Error loading user {self.public_id}: {e}")
                         time.sleep(5)
 
-    def lmdb_save(self, reviews: list, txn = None):        
+    def lmdb_save(self, reviews: list, txn = None, update: bool = False, page_token: str = None, failed: bool = False):
         """ """
-
-        def save_txn():
-            # logger.debug(f'lmdb save user {self.public_id}: {reviews}')
-            txn.put(b'user:' + self.public_id.encode(), json.dumps(data_reviews).encode())
-
-            for oid, odata in objects.items():
-                # logger.debug(f'lmdb save object {oid}: {odata}')
-                txn.put(b'object:' + oid.encode(), json.dumps(odata).encode(), overwrite=False)
-
-
-        # prepare data structures
-        objects = dict()
-        data_reviews = list()
-
-        for r in reviews:
-            # update objects
-            objects[r['object']['id']] = {
-                'name': r['object']['name'],
-                'address': r['object']['address']
-            }
-
-            created = datetime.datetime.strptime(r['date_created'].split('T')[0], "%Y-%m-%d")
-
-            data_reviews.append({
-                'rating': r['rating'],
-                'oid': r['object']['id'],
-                'uid':  r['user']['public_id'],
-                'user_name':  r['user']['name'],
-                'provider': r['provider'],
-                'created': created.strftime("%Y-%m-%d")
-            })
-
         if txn:
-            save_txn()
+            save_user_reviews(txn, self.public_id, reviews, update=update, page_token=page_token, failed=failed)
         else:
-            env = lmdb.open(settings.lmdb_storage.as_posix(), map_size=LMDB_MAP_SIZE)
+            with write_txn() as txn:
+                save_user_reviews(txn, self.public_id, reviews, update=update, page_token=page_token, failed=failed)
 
-            with env.begin(write=True) as txn:
-                save_txn()
+        # will be re-read from LMDB on next load()
+        self._set_record(None)
 
     def nreviews(self):
         self.load()
-        return len(self._reviews)
+        return len(self._record) if self._record else 0
 
-    def birthday(self):
+    def birthday_day(self):
+        """ day number of first review """
         self.load()
-        if not self._reviews:
-            # private profile
+        if 'birthday' not in self._memo:
+            if not self._record or not len(self._record.columns):
+                # private profile
+                self._memo['birthday'] = None
+            else:
+                self._memo['birthday'] = int(self._record.columns['created'].min())
+        return self._memo['birthday']
+
+    def birthday(self):
+        day = self.birthday_day()
+        if day is None:
             return None
-        try:
-            r = Review(sorted(self._reviews, key=lambda r: r['created'])[0])
-        except KeyError:
-            print_json(data=self._reviews)
-            raise
-        return r.created
+        return day_to_datetime(day)
+
+    def columns(self) -> np.ndarray:
+        """ reviews as structured array (oid, rating, created, provider) sorted by created, like reviews() """
+        self.load()
+        if 'columns' not in self._memo:
+            if self._record is None:
+                cols = np.empty(0, dtype=REVIEW_DTYPE)
+            else:
+                cols = self._record.columns
+                if settings.skip_oids:
+                    cols = cols[~np.isin(cols['oid'], [int(oid) for oid in settings.skip_oids])]
+                cols = cols[np.argsort(cols['created'], kind='stable')]
+            self._memo['columns'] = cols
+        return self._memo['columns']
 
     def towns(self):
         self.load()
@@ -187,10 +221,12 @@ class User:
 
     def reviews(self):
         self.load()
-        # reviews are sorted by date_edited desc, not by date_created, we need to re-sort
-        for r in sorted(self._reviews, key=lambda r: r['created']):
-            if r['oid'] in settings.skip_oids:
-                continue
+        if 'reviews' not in self._memo:
+            # reviews are sorted by date_edited desc, not by date_created, we need to re-sort
+            self._memo['reviews'] = [ r for r in sorted(self._reviews, key=lambda r: r['created']) 
+                                     if r['oid'] not in settings.skip_oids ]
+
+        for r in self._memo['reviews']:
             yield Review(r, user=self)
 
     def review_for(self, oid: str) -> Review:
@@ -198,7 +234,8 @@ class User:
             if r.oid == oid:
                 return r
 
-    def load_from_network(self):
+    def load_from_network(self, update: bool = False):
+        """ load all reviews, or (update=True) only reviews newer than stored and merge them """
 
         if db.is_private_profile(self.public_id):
             # logger.debug("skip: private profile from shelf", self.public_id)
@@ -209,71 +246,57 @@ class User:
         # why we were called?
         # print("".join(traceback.format_stack(limit=10))) 
 
-        url = f'https://api.auth.2gis.com/public-profile/1.1/user/{self.public_id}/content/feed?page_size=20'
+        url = settings.user_feed_url.format(public_id=self.public_id)
+        pager = FeedPager(self.public_id, meta=(get_usermeta(self.public_id) or dict()) if update else None)
 
         page = 0
-
-        _reviews = list()
+        throttled = 0
 
         while True:
             logger.debug(f"Loading user reviews p{page} for user {self} from {url}")
-            time.sleep(SLEEPTIME)
-            r = session.get(url)
+            profile_api.before()
+            r = session.get(url, params=pager.params())
             if r.status_code == 403:
                 # print("New private profile", self.public_id)
+                profile_api.ok()
                 db.add_private_profile(self.public_id)
                 return
             elif r.status_code in [400, 500]:
-                logger.warning(f"user {self} reviews error {r.status_code} url: {url}")
+                logger.warning(f"user {self} reviews error {r.status_code} url: {r.url}")
+                pager.error()
                 break
+            elif is_throttled(r):
+                # 429/502/503/504: same page again, last attempt too is a failure
+                profile_api.failed(retry_after(r))
+                throttled += 1
+                if throttled > settings.network_retries:
+                    raise AFNetworkError(f"Cannot load user {self.public_id}: HTTP {r.status_code} "
+                                         f"after {settings.network_retries} retries")
+                continue
             else:
                 r.raise_for_status()
-          
-            data = r.json()
-
-            for el in data['content_feed']:
-                try:
-                    review = el['review']
-                except KeyError:
-                    continue
-                _reviews.append(review)
-
-
-            # self.reviews.extend(data['reviews'])
+            profile_api.ok()
 
-            # prepare next page url
-            try:
-                token = data['next_page_token']                
-            except KeyError:
-                # logger.debug("no token in response")
+            if not pager.add_page(r.json()):
                 break
-
-            # logger.debug(f"token: {token}")
-            
-
-
-            parsed_url = urlparse(url)
-            query_params = parse_qs(parsed_url.query)
-            query_params['page_token'] = token
-            new_query = urlencode(query_params, doseq=True)
-            url = urlunparse(parsed_url._replace(query=new_query))
             page+=1
 
-
-        # print(f"user {self.name} loaded {len(self._reviews)} reviews")
-        # print("save to", self.reviews_path)
-        #with gzip.open(self.reviews_path, 'wt') as f:
-        #    json.dump(self._reviews, f)
         try:
-            self.lmdb_save(reviews=_reviews)
+            self.lmdb_save(reviews=pager.reviews, update=update, page_token=pager.incomplete, failed=pager.failed)
         except Exception as e:
             print(f"Error saving user {self.public_id}: {e}")            
             sys.exit(1)
 
+        if update:
+            logger.debug(f"user {self.public_id} updated: {len(pager.reviews)} new reviews, {page + 1} pages")
+
         # now we can load from database
         self.load()
-        statistics.total_users_loaded_network += 1
-        statistics.total_users_loaded += 1
+        statistics.inc(total_users_loaded_network=1, total_users_loaded=1)
+
+    def update_from_network(self):
+        """ delta update of stored user (only new reviews) """
+        self.load_from_network(update=True)
 
     @property
     def url(self):
@@ -281,24 +304,18 @@ class User:
 
     @property
     def name(self):
-        if self._reviews:
-
-            try:
-                return self._reviews[0]['user_name']
-            except KeyError:
-                return None
-            # return self._reviews[0]['user']['name']
+        if self._record:
+            return self._record.user_name
         else:
             return None
 
     @staticmethod
     def users():
-        env = lmdb.open(settings.lmdb_storage.as_posix(), readonly=True, map_size=LMDB_MAP_SIZE, lock=False)
         prefix = b'user:'
         key = prefix  # start with first 'user:'
 
         while True:
-            with env.begin() as txn:  # making lot of very SHORT transactions
+            with read_txn() as txn:  # making lot of very SHORT transactions
                 with txn.cursor() as cur:
                     if not cur.set_range(key):  
                         return  # The End
@@ -313,20 +330,14 @@ class User:
 
     @staticmethod
     def old_users_file():
-        env = lmdb.open(settings.lmdb_storage.as_posix(), readonly=True, map_size=LMDB_MAP_SIZE, lock=False)
         prefix = b'user:'
 
         with tempfile.NamedTemporaryFile(mode='w+', prefix='af2gis-users-', suffix='.txt', delete=False) as f:
             tmp_path = f.name
             print(f"Userlist in {tmp_path}")
-            with env.begin() as txn:
-                with txn.cursor() as cur:
-                    if cur.set_range(prefix):
-                        for key, _ in cur:
-                            if not key.startswith(prefix):
-                                break
-                            public_id = key.decode().split(':', 1)[1]
-                            f.write(public_id + '\n')
+            for key, _ in prefix_iter(prefix):
+                public_id = key.decode().split(':', 1)[1]
+                f.write(public_id + '\n')
 
         try:
             with open(tmp_path, 'r') as f:
@@ -340,43 +351,222 @@ class User:
     def old_users_iterator():
         #for file in settings.user_storage.glob('*-reviews.json.gz'):
         #    yield User(file.stem.split('-')[0])
-        env = lmdb.open(settings.lmdb_storage.as_posix(), readonly=True, map_size=LMDB_MAP_SIZE)
-        with env.begin() as txn:
-            with txn.cursor() as cur:
-                if cur.set_range(b'user:'):
-                    for key, value in cur:
-                        if not key.startswith(b'user:'):
-                            break
-                        public_id = key.decode().split(':')[1]
-                        yield User(public_id)
+        for key, value in prefix_iter(b'user:'):
+            public_id = key.decode().split(':')[1]
+            yield User(public_id)
 
 
     @staticmethod
     def nusers():
         n = 0
-        env = lmdb.open(settings.lmdb_storage.as_posix(), readonly=True, map_size=LMDB_MAP_SIZE)
-        with env.begin() as txn:
-            with txn.cursor() as cur:
-                if cur.set_range(b'user:'):
-                    for key, value in cur:
-                        if not key.startswith(b'user:'):
-                            break
-                        n+=1
+        for key, value in prefix_iter(b'user:'):
+            n+=1
         return n
 
 
     def __repr__(self):
-        return f'User({self.name} {self.url} rev: {len(self._reviews) if self._reviews else "not loaded"})'
+        return f'User({self.name} {self.url} rev: {len(self._record) if self._record else "not loaded"})'
+
+
+
+def review_edited(review: dict) -> str:
+    """ content/feed is sorted by this date (desc) """
+    return review.get('date_edited') or review['date_created']
+
+
+def get_usermeta(public_id: str, txn = None) -> dict:
+    """ usermeta:<public_id> (fetched_at, newest, nreviews, page_token) or None (not loaded or loaded before usermeta) """
+    key = USERMETA_PREFIX + public_id.encode()
+    val = txn.get(key) if txn is not None else lmdb_get(key)
+    return json.loads(val) if val else None
+
+
+def stale_users(public_ids) -> list:
+    """ users in LMDB fetched more than settings.user_stale_days ago (or with unknown fetch time) """
+    if not settings.user_stale_days:
+        return list()
+
+    public_ids = list(filter(None, public_ids))
+    stored = lmdb_getmulti(b"user:" + public_id.encode() for public_id in public_ids)
+    metas = lmdb_getmulti(USERMETA_PREFIX + public_id.encode() for public_id in public_ids)
+    threshold = (datetime.datetime.now() - datetime.timedelta(days=settings.user_stale_days)).isoformat()
+
+    stale = list()
+    for public_id in public_ids:
+        if b"user:" + public_id.encode() not in stored:
+            continue
+        meta = metas.get(USERMETA_PREFIX + public_id.encode())
+        if meta is None or (json.loads(meta)['fetched_at'] or '') < threshold:
+            stale.append(public_id)
+    return stale
 
 
+class FeedPager:
+    """ pagination over content/feed of one user
+
+        full load (meta is None) or update (meta from usermeta:): pages are read until review
+        not newer than meta['newest'] (already stored), then unfinished tail of feed is read
+        from meta['page_token'] if previous load stopped on error.
+    """
+
+    def __init__(self, public_id: str, meta: dict = None):
+        self.public_id = public_id
+        self.meta = meta
+        self.token = None
+        self.resumed = False
+        self.reviews = list()
+        # token to continue later if stopped on error
+        self.incomplete = None
+        # stopped on error
+        self.failed = False
+
+    @property
+    def update(self) -> bool:
+        return self.meta is not None
+
+    def params(self) -> dict:
+        params = { 'page_size': FEED_PAGE_SIZE }
+        if self.token:
+            params['page_token'] = self.token
+        return params
+
+    def add_page(self, data: dict) -> bool:
+        """ process page, returns True if next page is needed """
+        newest = self.meta.get('newest') if self.meta and not self.resumed else None
+        reached = False
+
+        for el in data['content_feed']:
+            try:
+                review = el['review']
+            except KeyError:
+                continue
+            if newest and review_edited(review) <= newest:
+                reached = True
+                continue
+            self.reviews.append(review)
+
+        self.token = data.get('next_page_token')
+        if reached:
+            self.token = None
+            if self.meta.get('page_token'):
+                self.token = self.meta['page_token']
+                self.resumed = True
+        return self.token is not None
+
+    def error(self):
+        """ 400/500 on current page, stop. tail can be loaded on next update unless resumed token failed again """
+        self.failed = True
+        if self.resumed and self.token == self.meta.get('page_token'):
+            self.incomplete = None
+        else:
+            self.incomplete = self.token
+
+
+def save_user_reviews(txn, public_id: str, reviews: list, update: bool = False, page_token: str = None, failed: bool = False):
+    """ save user reviews (as returned by content/feed API), their objects and usermeta in LMDB write transaction
+
+        update: merge with stored reviews (new reviews replace stored ones for same object)
+        failed: feed loading stopped on error. User stays stale (fetched_at is not changed), in update mode
+            stored newest and page_token are kept, nothing is saved if nothing was loaded
+    """
+
+    if update and failed and not reviews:
+        return
+
+    # prepare data structures
+    objects = dict()
+    data_reviews = list()
+    user_name = reviews[0]['user']['name'] if reviews else None
+    meta = get_usermeta(public_id, txn) if update else None
+
+    for r in reviews:
+        # update objects
+        objects[r['object']['id']] = {
+            'name': r['object']['name'],
+            'address': r['object']['address']
+        }
+
+        data_reviews.append({
+            'rating': r['rating'],
+            'oid': r['object']['id'],
+            'uid':  r['user']['public_id'],
+            'user_name':  r['user']['name'],
+            'provider': r['provider'],
+            'created': r['date_created'][:10]
+        })
+
+    if update:
+        stored = txn.get(b'user:' + public_id.encode())
+        if stored:
+            record = UserRecord(public_id, stored)
+            user_name = user_name or record.user_name
+            new_oids = set(r['oid'] for r in data_reviews)
+            data_reviews.extend(r for r in record.reviews() if r['oid'] not in new_oids)
+
+    # logger.debug(f'lmdb save user {public_id}: {reviews}')
+    txn.put(b'user:' + public_id.encode(), encode_user(user_name, data_reviews))
+
+    newest = max((review_edited(r) for r in reviews), default=None)
+    if meta and meta.get('newest') and (newest is None or meta['newest'] > newest):
+        newest = meta['newest']
+    fetched_at = datetime.datetime.now().isoformat(timespec='seconds')
+    if failed:
+        # not fresh, will be updated again (None is stale too)
+        fetched_at = meta.get('fetched_at') if meta else None
+        if update:
+            # new reviews are loaded only down to error, older new reviews are missing:
+            # keep stored newest and tail token, next update reads head again down to stored newest
+            newest = meta.get('newest') if meta else None
+            page_token = meta.get('page_token') if meta else None
+    txn.put(USERMETA_PREFIX + public_id.encode(), json.dumps({
+        'fetched_at': fetched_at,
+        'newest': newest,
+        'nreviews': len(data_reviews),
+        'page_token': page_token
+    }).encode())
+
+    for oid, odata in objects.items():
+        # logger.debug(f'lmdb save object {oid}: {odata}')
+        txn.put(b'object:' + oid.encode(), json.dumps(odata).encode(), overwrite=False)
+
 
 def get_user(public_id: str) -> User:
-    global user_pool
+    user_pool = _user_pool()
     if public_id not in user_pool:
         user_pool[public_id] = User(public_id)
         # print(f"new user {public_id}")
     return user_pool[public_id]
 
+def load_users(public_ids) -> dict:
+    """ get users from pool or read all missing users from LMDB in one transaction. returns dict public_id -> User """
+    user_pool = _user_pool()
+    public_ids = set(filter(None, public_ids))
+
+    missing = [ public_id for public_id in public_ids if public_id not in user_pool ]
+    found = lmdb_getmulti(b"user:" + public_id.encode() for public_id in missing)
+
+    for key, val in found.items():
+        public_id = key[5:].decode()
+        user_pool[public_id] = User(public_id, data=val)
+
+    return { public_id: user_pool[public_id] for public_id in public_ids if public_id in user_pool }
+
+def random_user() -> str:
+    """ public_id of random user in LMDB (None if no users) """
+    prefix = b'user:'
+    with read_txn() as txn:
+        with txn.cursor() as cur:
+            # public_ids are hex strings, jump to random place
+            if not cur.set_range(prefix + f'{random.getrandbits(32):08x}'.encode()) or not cur.key().startswith(prefix):
+                if not cur.set_range(prefix) or not cur.key().startswith(prefix):
+                    return None
+            return cur.key()[len(prefix):].decode()
+
 def reset_user_pool():
-    global user_pool
-    user_pool = dict()
\ No newline at end of file
+    _pool.users = dict()
+
+def forget_users(public_ids):
+    """ drop users from pool (e.g. after update in LMDB) """
+    user_pool = _user_pool()
+    for public_id in public_ids:
+        user_pool.pop(public_id, None)
@@ -0,0 +1,165 @@
+import datetime
+import json
+import struct
+import numpy as np
+
+from .utils import EPOCH_ORDINAL, date_to_day
+
+"""
+    Compact binary encoding for LMDB user:<public_id> records.
+
+    Old records are JSON list of dicts (first byte is '['), they are still decoded transparently.
+
+    Binary record (version 1), little-endian:
+        header:     MAGIC (2s) VERSION (B) NPROVIDERS (B) NAMELEN (H) NREVIEWS (I)
+        name:       NAMELEN bytes, utf-8
+        providers:  NPROVIDERS times: LEN (B) + utf-8 bytes
+        reviews:    NREVIEWS times REVIEW_DTYPE (oid, rating, created, provider)
+
+rating NO_RATING (255) means no rating (e.g. 4sq, older records have 0 for it),
+    created is day number since 1970-01-01 (see utils.date_to_day), provider is index in providers table.
+"""
+
+MAGIC = b'AF'
+RECORD_VERSION = 1
+
+HEADER = struct.Struct('<2sBBHI')
+
+# stored instead of None, must not be used in rating averages (see rated())
+NO_RATING = 255
+
+REVIEW_DTYPE = np.dtype([
+    ('oid', '<u8'),
+    ('rating', 'u1'),
+    ('created', '<u2'),
+    ('provider', 'u1')
+])
+
+
+
+def encode_rating(rating) -> int:
+    return NO_RATING if rating is None else rating
+
+
+def decode_rating(rating: int):
+    """ stored rating to int or None """
+    return None if rating in (0, NO_RATING) else rating
+
+
+def rated(ratings: np.ndarray) -> np.ndarray:
+    """ mask of real ratings in rating column """
+    return (ratings != 0) & (ratings != NO_RATING)
+
+
+def is_binary(data: bytes) -> bool:
+    return bytes(data[:2]) == MAGIC
+
+
+def column_oid(oid: str) -> bool:
+    """ can oid be stored in oid column? """
+    return oid.isdigit() and int(oid) < 1 << 64
+
+
+def encodable(reviews: list) -> bool:
+    """ can these reviews be stored in binary record? """
+    for r in reviews:
+        if not column_oid(r['oid']):
+            return False
+    return len({r['provider'] for r in reviews}) < 256
+
+
+def encode_user(user_name: str, reviews: list) -> bytes:
+    """ reviews are dicts in LMDB format: rating, oid, provider, created (YYYY-MM-DD) """
+
+    if not encodable(reviews):
+        # rare weird oids, keep them in old format
+        return json.dumps(reviews).encode()
+
+    providers = list()
+    records = list()
+    for r in reviews:
+        provider = r['provider'] or ''
+        if provider not in providers:
+            providers.append(provider)
+        records.append((int(r['oid']), encode_rating(r['rating']), date_to_day(r['created']), providers.index(provider)))
+
+    name = (user_name or '').encode()
+    parts = [ HEADER.pack(MAGIC, RECORD_VERSION, len(providers), len(name), len(records)), name ]
+    for provider in providers:
+        pbytes = provider.encode()
+        parts.append(struct.pack('<B', len(pbytes)) + pbytes)
+    parts.append(np.array(records, dtype=REVIEW_DTYPE).tobytes())
+
+    return b''.join(parts)
+
+
+def decode_header(data: bytes):
+    """ returns (user_name, providers, nreviews, offset of reviews array) """
+    magic, version, nproviders, namelen, nreviews = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != RECORD_VERSION:
+        raise ValueError(f"Unsupported user record {bytes(data[:3])!r}")
+
+    offset = HEADER.size
+    user_name = bytes(data[offset:offset + namelen]).decode() or None
+    offset += namelen
+
+    providers = list()
+    for _ in range(nproviders):
+        plen = data[offset]
+        providers.append(bytes(data[offset + 1:offset + 1 + plen]).decode() or None)
+        offset += 1 + plen
+
+    return user_name, providers, nreviews, offset
+
+
+class UserRecord:
+    """ decoded LMDB user record
+
+        columns is structured array (REVIEW_DTYPE) of all reviews. For binary records it is a view
+        on record bytes (no copy, no per-review objects), review dicts are built only if reviews() is called.
+    """
+
+    def __init__(self, public_id: str, data: bytes):
+        """ reviews of old JSON records with weird oids (cannot be in columns) are dropped,
+            so len(), reviews() and columns describe same reviews """
+        self.public_id = public_id
+
+        if is_binary(data):
+            self.user_name, self.providers, self.nreviews, offset = decode_header(data)
+            self.columns = np.frombuffer(data, dtype=REVIEW_DTYPE, count=self.nreviews, offset=offset)
+            self._reviews = None
+        else:
+            # old JSON record
+            reviews = json.loads(data)
+            self.user_name = reviews[0].get('user_name') if reviews else None
+            self._reviews = [ r for r in reviews if column_oid(r['oid']) ]
+            self.nreviews = len(self._reviews)
+            self.providers = list()
+            records = list()
+            for r in self._reviews:
+                if r['provider'] not in self.providers:
+                    self.providers.append(r['provider'])
+                records.append((int(r['oid']), encode_rating(r['rating']), date_to_day(r['created']), self.providers.index(r['provider'])))
+            self.columns = np.array(records, dtype=REVIEW_DTYPE)
+
+    def reviews(self) -> list:
+        """ list of review dicts (LMDB format) """
+        if self._reviews is None:
+            self._reviews = [ {
+                'rating': decode_rating(rating),
+                'oid': str(oid),
+                'uid': self.public_id,
+                'user_name': self.user_name,
+                'provider': self.providers[provider],
+                'created': datetime.date.fromordinal(EPOCH_ORDINAL + created).isoformat(),
+                'created_day': created
+            } for oid, rating, created, provider in self.columns.tolist() ]
+        return self._reviews
+
+    def __len__(self):
+        return self.nreviews
+
+
+def decode_user(public_id: str, data: bytes) -> list:
+    """ decode user record (either format) into list of review dicts """
+    return UserRecord(public_id, data).reviews()
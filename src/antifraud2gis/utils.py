@@ -1,7 +1,11 @@
 import random
+import datetime
 from pathlib import Path
 import os
+import threading
+from collections import OrderedDict
 from typing import Optional
+from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
 
 from .settings import settings
 
@@ -17,5 +21,84 @@ def random_file(path: Path) -> Optional[Path]:
                     chosen = Path(entry.path)
     return chosen
 
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+_today = None
+
+def date_to_day(date: str) -> int:
+    """ '2025-05-04' or '2025-05-04T16:15:35.123+07:00' to day number (days since 1970-01-01) """
+    return datetime.date.fromisoformat(date[:10]).toordinal() - EPOCH_ORDINAL
+
+def day_to_datetime(day: int) -> datetime.datetime:
+    return datetime.datetime.fromordinal(EPOCH_ORDINAL + int(day))
+
+def today() -> int:
+    """ current day number. Same value until reset_today(), so all ages within one run are consistent """
+    global _today
+    if _today is None:
+        _today = datetime.date.today().toordinal() - EPOCH_ORDINAL
+    return _today
+
+def reset_today():
+    global _today
+    _today = None
+
+def next_page_url(url: str, max_offset: int = None) -> Optional[str]:
+    """ url of next page for offset/limit paginated API, None if url has no offset or max_offset reached """
+    parsed = urlparse(url)
+    query = parse_qs(parsed.query)
+    if 'offset' not in query or 'limit' not in query:
+        return None
+    offset = int(query['offset'][0]) + int(query['limit'][0])
+    if max_offset is not None and offset >= max_offset:
+        return None
+    query['offset'] = [ str(offset) ]
+    return urlunparse(parsed._replace(query=urlencode(query, doseq=True)))
+
+def same_url(a: str, b: str) -> bool:
+    """ same url, ignoring order of query parameters """
+    pa, pb = urlparse(a), urlparse(b)
+    return pa._replace(query='') == pb._replace(query='') and parse_qs(pa.query) == parse_qs(pb.query)
+
 def random_company() -> str:
-    return random_file(settings.company_storage).name.split('-')[0]
\ No newline at end of file
+    return random_file(settings.company_storage).name.split('-')[0]
+
+class LRUCache:
+    """ bounded dict, least recently used items are dropped first (thread-safe) """
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return f"LRUCache(size={len(self._data)}/{self.maxsize} hits={self.hits} misses={self.misses})"
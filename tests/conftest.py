@@ -0,0 +1,5 @@
+import os
+import tempfile
+
+# isolated storage (~/.af2gis-storage), must be set before antifraud2gis.settings is imported
+os.environ['HOME'] = tempfile.mkdtemp(prefix='af2gis-test-')
@@ -0,0 +1,128 @@
+import datetime
+import gzip
+import json
+import random
+
+import pytest
+
+from antifraud2gis.settings import settings
+from antifraud2gis.lmdbenv import write_txn
+from antifraud2gis.userrecord import encode_user
+from antifraud2gis.company import Company, CompanyList
+from antifraud2gis.exceptions import AFNoCompany
+from antifraud2gis.user import User, reset_user_pool
+from antifraud2gis.fraud import detect
+import antifraud2gis.company
+
+"""
+    BATCH_DETECT parity: score_batch() over ReviewTable must give same score, relations and explain
+    as streaming feed() of each review.
+"""
+
+TOWNS = ['Новосибирск', 'Москва', 'Томск', 'Омск']
+TODAY = datetime.date.today().toordinal()
+
+
+def day_str(days_ago: int) -> str:
+    return datetime.date.fromordinal(TODAY - days_ago).isoformat()
+
+
+def make_company(oid: str, nreviews: int, bot_ratio: float, seed: int):
+    """ company oid with nreviews, part of them from bots (new users, same companies, rating 5) """
+    rnd = random.Random(seed)
+    oids = [ str(int(oid) + 1000 + i) for i in range(200) ]
+
+    with write_txn() as txn:
+        txn.put(b'object:' + oid.encode(), json.dumps({'name': 'Тест, ресторан', 'address': 'Новосибирск, Ленина, 1'}).encode())
+        for i, boid in enumerate(oids):
+            obj = {'name': f'Кафе {i % 30}, кафе', 'address': f'{TOWNS[i % 4]}, ул. {i}'}
+            txn.put(b'object:' + boid.encode(), json.dumps(obj).encode())
+
+        company_reviews = list()
+        for n in range(nreviews):
+            uid = f'{seed:04x}{n:028x}'
+            bot = rnd.random() < bot_ratio
+            # some reviews without user, some users not in LMDB (private)
+            public_id = None if n % 17 == 0 else uid
+            arating = 5 if bot else rnd.randint(1, 5)
+            days_ago = rnd.randint(0, 600)
+            company_reviews.append({
+                'id': f'{seed}-{n}', 'rating': arating, 'object': {'id': oid},
+                'user': {'public_id': public_id, 'name': f'U{n}'},
+                'provider': rnd.choice(['2gis', '2gis', 'flamp']),
+                'date_created': f'{day_str(days_ago)}T10:11:12.000+07:00', 'text': 'x'
+            })
+            if public_id is None or n % 11 == 0:
+                continue
+
+            nrev = rnd.randint(1, 4) if bot else rnd.randint(2, 60)
+            reviews = [ {'rating': arating, 'oid': oid, 'provider': '2gis', 'created': day_str(days_ago)} ]
+            pool = oids[:15] if bot else oids[15:]
+            for boid in rnd.sample(pool, min(nrev - 1, len(pool))):
+                brating = 5 if bot else rnd.choice([1, 2, 3, 4, 5, None])
+                reviews.append({'rating': brating, 'oid': boid, 'provider': '2gis',
+                                'created': day_str(days_ago + (rnd.randint(0, 20) if bot else rnd.randint(0, 900)))})
+            if n % 7 == 0:
+                # weird oid: old JSON record (with uid, user_name), review is not in columns
+                reviews.append({'rating': 4, 'oid': f'x{n}', 'provider': '2gis', 'created': day_str(days_ago)})
+                reviews = [ dict(r, uid=uid, user_name=f'U{n}') for r in reviews ]
+            txn.put(b'user:' + uid.encode(), encode_user(f'U{n}', reviews))
+
+    for i, boid in enumerate(oids[:30]):
+        with gzip.open(settings.company_storage / f'{boid}-basic.json.gz', 'wt') as fh:
+            json.dump({'version': 4, 'title': f'Кафе {i % 30}, кафе', 'alias': None, 'remark': None,
+                       'address': f'{TOWNS[i % 4]}, ул. {i}', 'tags': None}, fh)
+
+    with gzip.open(settings.company_storage / f'{oid}-reviews.json.gz', 'wt') as fh:
+        json.dump(company_reviews, fh)
+
+
+@pytest.fixture(autouse=True)
+def no_network(monkeypatch):
+    def nocompany(self):
+        raise AFNoCompany(f"no network for {self.object_id}")
+
+    monkeypatch.setattr(User, 'load_from_network', lambda self, update=False: None)
+    monkeypatch.setattr(Company, 'load_reviews_from_network', nocompany)
+    monkeypatch.setattr(antifraud2gis.company, 'crawl_users', lambda public_ids, update=False: None)
+    monkeypatch.setattr(settings, 'company_stale_days', 0)
+    monkeypatch.setattr(settings, 'user_stale_days', 0)
+
+
+def run_detect(oid: str, batch: bool, monkeypatch) -> dict:
+    monkeypatch.setattr(settings, 'batch_detect', batch)
+    reset_user_pool()
+    c = Company(oid)
+    c.explain_path.unlink(missing_ok=True)
+
+    score = detect(c, CompanyList(), force=True)
+    score.pop('date', None)
+    with gzip.open(c.report_path, 'rt') as fh:
+        relations = json.load(fh)['relations']
+    explain = None
+    if c.explain_path.exists():
+        with gzip.open(c.explain_path, 'rt') as fh:
+            explain = fh.read()
+    return {'score': score, 'relations': relations, 'explain': explain}
+
+
+@pytest.mark.parametrize('oid,nreviews,bot_ratio,seed', [
+    ('70000001000000001', 300, 0.1, 1),
+    ('70000001000100001', 300, 0.5, 2),
+    ('70000001000200001', 120, 0.8, 3),
+])
+def test_batch_detect_parity(oid, nreviews, bot_ratio, seed, monkeypatch):
+    make_company(oid, nreviews, bot_ratio, seed)
+
+    # legacy records: nreviews() and columns() see same reviews
+    user = User(f'{seed:04x}{7:028x}')
+    assert user._record._reviews is not None
+    assert user.nreviews() == len(user.columns()) == len(list(user.reviews()))
+
+    streaming = run_detect(oid, False, monkeypatch)
+    batch = run_detect(oid, True, monkeypatch)
+
+    assert streaming['relations']
+    if not streaming['score']['trusted']:
+        assert streaming['explain']
+    assert batch == streaming
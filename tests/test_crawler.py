@@ -0,0 +1,205 @@
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+from antifraud2gis.settings import settings
+from antifraud2gis.crawler import UserCrawler
+from antifraud2gis.user import User, get_usermeta
+from antifraud2gis.exceptions import AFNetworkError
+from antifraud2gis.userrecord import UserRecord
+from antifraud2gis.lmdbenv import lmdb_get
+from antifraud2gis.db import db
+import antifraud2gis.crawler
+import antifraud2gis.user
+
+"""
+    UserCrawler (and User.load() of one user) against local stub of content/feed API.
+"""
+
+PAGES = 3
+
+
+def feed_review(public_id: str, n: int) -> dict:
+    return {
+        'rating': n % 5 + 1, 'provider': '2gis',
+        'object': {'id': str(70000000000000 + n), 'name': f'Кафе {n}, кафе', 'address': f'Томск, ул. {n}'},
+        'user': {'public_id': public_id, 'name': f'User {public_id}'},
+        'date_created': f'2024-01-{n + 1:02d}T10:00:00.000+07:00'
+    }
+
+
+class FeedStub(BaseHTTPRequestHandler):
+    """ public_id prefix selects behaviour: ok, private (403), throttled (429 once), broken (500 on page 2),
+        busy (always 503), badjson (invalid body) """
+
+    lock = threading.Lock()
+    hits = dict()
+    inflight = 0
+    max_inflight = 0
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status: int, body: bytes = b'', headers: dict = None):
+        self.send_response(status)
+        for k, v in (headers or dict()).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        public_id = url.path.split('/')[2]
+        page = int(parse_qs(url.query).get('page_token', ['0'])[0])
+
+        cls = type(self)
+        with cls.lock:
+            cls.hits[public_id] = cls.hits.get(public_id, 0) + 1
+            hits = cls.hits[public_id]
+            cls.inflight += 1
+            cls.max_inflight = max(cls.max_inflight, cls.inflight)
+        try:
+            time.sleep(0.02)
+            self.respond(public_id, page, hits)
+        finally:
+            with cls.lock:
+                cls.inflight -= 1
+
+    def respond(self, public_id: str, page: int, hits: int):
+        if public_id.startswith('private'):
+            return self.reply(403)
+        if public_id.startswith('busy') or (public_id.startswith('throttled') and hits == 1):
+            return self.reply(429 if public_id.startswith('throttled') else 503, headers={'Retry-After': '0'})
+        if public_id.startswith('broken') and page == 1:
+            return self.reply(500)
+        if public_id.startswith('badjson'):
+            return self.reply(200, b'not json')
+
+        data = {'content_feed': [ {'review': feed_review(public_id, page * 2 + i)} for i in range(2) ]}
+        if page + 1 < PAGES:
+            data['next_page_token'] = str(page + 1)
+        self.reply(200, json.dumps(data).encode(), {'Content-Type': 'application/json'})
+
+
+class RecordingEndpoint:
+    """ profile_api without Redis and sleeps """
+
+    def __init__(self):
+        self.nok = 0
+        self.pauses = list()
+
+    def before(self):
+        pass
+
+    def ok(self):
+        self.nok += 1
+
+    def failed(self, pause: float = None):
+        self.pauses.append(pause)
+
+
+@pytest.fixture
+def feed(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FeedStub)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    FeedStub.hits = dict()
+    FeedStub.max_inflight = 0
+
+    endpoint = RecordingEndpoint()
+    monkeypatch.setattr(antifraud2gis.crawler, 'profile_api', endpoint)
+    monkeypatch.setattr(antifraud2gis.user, 'profile_api', endpoint)
+    monkeypatch.setattr(settings, 'user_feed_url', f'http://127.0.0.1:{server.server_port}/user/{{public_id}}/content/feed')
+    monkeypatch.setattr(settings, 'network_retries', 2)
+    monkeypatch.setattr(settings, 'proxy', None)
+    yield endpoint
+    server.shutdown()
+    server.server_close()
+
+
+def crawl(public_ids, **kwargs) -> UserCrawler:
+    """ crawl in thread, fail instead of hanging """
+    crawler = UserCrawler(rate=0, **kwargs)
+    thread = threading.Thread(target=crawler.crawl, args=(public_ids,), daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    assert not thread.is_alive(), "crawl hangs"
+    return crawler
+
+
+def stored(public_id: str) -> UserRecord:
+    val = lmdb_get(b'user:' + public_id.encode())
+    return UserRecord(public_id, val) if val else None
+
+
+def test_concurrent_crawl(feed):
+    public_ids = [ f'ok{i:03d}' for i in range(40) ]
+    crawler = crawl(public_ids, concurrency=8, batch=7)
+
+    assert (crawler.loaded, crawler.private, crawler.failed) == (40, 0, 0)
+    assert FeedStub.max_inflight > 1
+    for public_id in public_ids:
+        record = stored(public_id)
+        assert len(record) == PAGES * 2
+        assert record.user_name == f'User {public_id}'
+        meta = get_usermeta(public_id)
+        assert meta['fetched_at'] and meta['page_token'] is None
+
+
+def test_private_profile(feed):
+    crawler = crawl(['private1', 'ok100'], concurrency=2)
+
+    assert (crawler.loaded, crawler.private, crawler.failed) == (1, 1, 0)
+    assert db.is_private_profile('private1')
+    assert stored('private1') is None
+
+
+def test_throttled_retry(feed):
+    crawler = crawl(['throttled1'], concurrency=1)
+
+    assert (crawler.loaded, crawler.failed) == (1, 0)
+    assert feed.pauses == [0.0]
+    assert len(stored('throttled1')) == PAGES * 2
+
+
+def test_throttled_exhausted(feed):
+    crawler = crawl(['busy1'], concurrency=1)
+
+    assert (crawler.loaded, crawler.failed) == (0, 1)
+    # every throttled response (last one too) is reported to profile_api
+    assert FeedStub.hits['busy1'] == settings.network_retries + 1
+    assert feed.pauses == [0.0] * (settings.network_retries + 1)
+    assert stored('busy1') is None
+
+
+def test_partial_feed(feed):
+    crawler = crawl(['broken1'], concurrency=1)
+
+    assert (crawler.loaded, crawler.failed) == (1, 0)
+    # first page saved, tail can be resumed, user stays stale
+    assert len(stored('broken1')) == 2
+    meta = get_usermeta('broken1')
+    assert meta['page_token'] == '1'
+    assert meta['fetched_at'] is None
+
+
+def test_fetcher_error_does_not_hang(feed):
+    public_ids = [ f'badjson{i}' for i in range(10) ] + [ f'ok2{i:02d}' for i in range(10) ]
+    crawler = crawl(public_ids, concurrency=2, batch=3)
+
+    assert (crawler.loaded, crawler.failed) == (10, 10)
+
+
+def test_user_load_throttle_budget(feed):
+    """ one retry budget for throttled user: lmdb_load does not repeat load_from_network retries """
+    user = User('busy2')
+    with pytest.raises(AFNetworkError):
+        user.load()
+
+    assert FeedStub.hits['busy2'] == settings.network_retries + 1
+    assert feed.pauses == [0.0] * (settings.network_retries + 1)